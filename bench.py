@@ -0,0 +1,532 @@
+import os
+import re
+import shutil
+import tempfile
+import sys
+import math
+import time
+import multiprocessing
+import json
+import asyncio
+import resource
+import subprocess
+import traceback
+from queue import Empty
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import lxml.html
+import extract
+import write
+import columnar
+from document import Document
+from scrape import Scrape
+import patterns
+import replay
+
+# Offline benchmarks over filings already saved by scrape.py into ./htmls/
+# Usage: python bench.py parse [folder]
+#        python bench.py values [folder]
+#        python bench.py patterns [folder] [worst case bytes]
+#        python bench.py title [folder]
+#        python bench.py write [sheets]
+#        python bench.py columnar [filings]
+#        python bench.py suite [fixtures] [corpus] [latency ms]
+#
+# suite replays a recorded EDGAR (see replay.py) for a full scrape run, then extracts and writes every table of a fixed
+# corpus of saved filings. Each part runs in its own process for a clean peak RSS; results are appended to
+# ./bench/results.jsonl and compared with the previous run.
+
+
+def savedFilings(folder):
+    # Saved names look like '<company> - <reference> - <type>.html'
+    queue = []
+    for f in sorted(y for x in os.walk(folder) for y in glob(os.path.join(x[0], '*.html'))):
+        name = os.path.basename(f).replace('.html', '').split(' - ')
+        with open(f, encoding='utf-8') as fh:
+            queue.append((f, { 'type': name[-1] }, fh.read()))
+    return queue
+
+
+def cpu(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        t = time.process_time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def benchParse(folder='./htmls/'):
+    # 'before' re-parses the document for every extractor call, as getTitle/getPages used to.
+    # 'after' parses it once and shares the Document.
+    s = Scrape.__new__(Scrape)          # The metadata extractors don't touch instance state
+
+    def before(html, filing):
+        title = s.getTitleByP(Document(html)) if filing['type'] == '6-K' else ''
+        if not title:
+            title = s.getTitleByDiv(Document(html))
+        return title, s.getPages(Document(html))
+
+    def after(html, filing):
+        doc = Document(html)
+        return s.getTitle(doc, filing), s.getPages(doc)
+
+    queue = savedFilings(folder)
+    if not queue:
+        print('No saved filings found in {}'.format(folder))
+        return
+    totals = [0, 0]
+    print('{:<60} {:>10} {:>10} {:>8}'.format('Filing', 'Before ms', 'After ms', 'Speedup'))
+    for f, filing, html in queue:
+        b = cpu(lambda: before(html, filing))
+        a = cpu(lambda: after(html, filing))
+        if before(html, filing) != after(html, filing):
+            print('-- Err: results differ for {}'.format(f))
+        totals[0] += b
+        totals[1] += a
+        print('{:<60} {:>10.1f} {:>10.1f} {:>7.1f}x'.format(os.path.basename(f)[:60], b * 1000, a * 1000, b / a if a else 0))
+    n = len(queue)
+    print('\nPer filing: {:.1f} ms before, {:.1f} ms after over {} filings'.format(totals[0] / n * 1000, totals[1] / n * 1000, n))
+
+
+def sameValues(a, b):
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if len(x) != len(y):
+            return False
+        for p, q in zip(x, y):
+            if type(p) != type(q) and not (isinstance(p, float) and isinstance(q, float)):
+                return False
+            if p != q and not (isinstance(p, float) and math.isnan(p) and math.isnan(q)):
+                return False
+    return True
+
+
+def legacyParseValues(values):
+    # Extract.parseValues as it was before the cleaning loop was tightened
+    parsed = [None] * len(values)
+    mware = [None] * len(values)
+    for i, v in enumerate(values):
+        if not v:
+            parsed[i] = v
+            continue
+        if (v == ')' or v == '%' or v == ')%') and mware[i - 1]:
+            mware[i - 1] += v
+        elif re.match(r"^[$£]$", v):
+            pass
+        else:
+            if not mware[i]:
+                mware[i] = ''
+            mware[i] += v
+    for i, v in enumerate(mware):
+        if not v:
+            parsed[i] = v
+            continue
+        if v.startswith('(') and v.endswith(')'):
+            v = '-' + v[1:-1]
+        v = v.replace(',', '')
+        if v == '—':
+            parsed[i] = 0
+            continue
+        try:
+            parsed[i] = float(v)
+        except:
+            parsed[i] = v
+    return parsed
+
+
+def benchValues(folder='./htmls/', minCells=0):
+    # 'before' is the old parseValues row by row, 'after' is Extract.parseTable, over every table's cells
+    e = extract.Extract.__new__(extract.Extract)    # Only the cleaning methods are used
+    tables = []
+    for f, filing, html in savedFilings(folder):
+        root = lxml.html.document_fromstring(html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+        for table in root.iter('table'):
+            rows = [[v for v, colspan in cells] for text, cells in extract.lxmlRows(table)]
+            if sum(len(r) for r in rows) > minCells:
+                tables.append(rows)
+    if not tables:
+        print('No tables found in {}'.format(folder))
+        return
+    cells = sum(len(r) for t in tables for r in t)
+    e.currency = ''
+    before = cpu(lambda: [[legacyParseValues(r) for r in t] for t in tables])
+    after = cpu(lambda: [e.parseTable(t) for t in tables])
+    mismatched = sum(1 for t in tables if not sameValues([legacyParseValues(r) for r in t], e.parseTable(t)))
+    print('{} tables, {} cells'.format(len(tables), cells))
+    print('Old parseValues: {:.1f} ms, parseTable: {:.1f} ms, {:.1f}x'.format(before * 1000, after * 1000, before / after if after else 0))
+    print('Tables with different values: {}'.format(mismatched))
+
+
+# The regex code scrape.py used before patterns.py, kept here as the baseline
+
+def legacyTitleByP(html):
+    title = ''
+    matches = re.findall(r"<p.*><b>.*[a-zA-Z]+.*<\/b><\/p>", html)
+    for m in matches:
+        groups = re.search(r"<p.*><b>.*([a-zA-Z]+).*<\/b><\/p>", m)
+        if not len(groups.groups()):
+            continue
+        group = groups.group(1)
+        bolds = re.findall(r"<b>(?:<.*?>)?([\w\s]+)(?:<\/.*?>)?<\/b>", group)
+        for b in bolds:
+            gs = re.search(r"<b>(?:<.*?>)?([\w\s]+)(?:<\/.*?>)?<\/b>", b)
+            if not len(gs.groups()):
+                continue
+            bold = gs.group(1)
+            if 'exhibit' in bold.lower() or bold == '&nbsp;':
+                continue
+            title += bold
+            break
+    return title
+
+
+def legacyTitleByDiv(html):
+    title = ''
+    matches = re.findall(r"<div.*><span>.*[a-zA-Z]+.*<\/span><\/div>", html)
+    for m in matches:
+        groups = re.search(r"<div.*><span>.*([a-zA-Z]+).*<\/span><\/div>", m)
+        if not len(groups.groups()):
+            continue
+        group = groups.group(1)
+        bolds = re.findall(r"<span.*?style=.*?font-weight:\s?bold.*?>(?:<.*?>)??(?:[\w\s-]|&nbsp;)+(?:<\/.*?>)??<\/span>", group)
+        for b in bolds:
+            gs = re.search(r"<span.*?style=.*?font-weight:\s?bold.*?>(?:<.*?>)??((?:[\w\s-]|&nbsp;)+)(?:<\/.*?>)??<\/span>", b)
+            if not len(gs.groups()):
+                continue
+            bold = gs.group(1)
+            b = bold.lower().strip()
+            if not b or 'exhibit' in b or bold == '&nbsp;':
+                continue
+            s = re.search(r"For\s+the\s+(fiscal\s+year|quarterly\s+period)\s+ended:?\s+(\w+\s+\d{1,2},\s+\d{1,4})", b)
+            if not s:
+                continue
+            title += s.group(0)
+            break
+    return title
+
+
+def legacyFallbacks(html):
+    return legacyTitleByP(html), legacyTitleByDiv(html)
+
+
+def fallbacks(html):
+    s = Scrape.__new__(Scrape)
+    doc = Document(html, parse=False)
+    return s.getTitleByP(doc), s.getTitleByDiv(doc)
+
+
+def worstCase(size):
+    # One line of unclosed bold paragraphs and spans: every '<p' and '<div' start makes the old .* patterns
+    # run to the end of the line and backtrack
+    unit = '<p style="margin:0"><b>Results for the period</b> <div><span style="font-weight:bold">For the fiscal year ended December 31, 2019 '
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+def loneSpan(size):
+    # One '<span' that is never closed, then style attributes that stop a letter short of bold. A tag pattern that
+    # scans for style= and then again for font-weight tries every style= against every later position
+    unit = ' style="color:#000; font-weight: bol"'
+    return '<span' + unit * (size // len(unit))
+
+
+# boldSpan as first made linear across tags, with the two scans of one tag body still nested
+nestedBoldSpan = re.compile(r"<span\b[^<>]*?\bstyle=[^<>]*?font-weight:\s?bold[^<>]*>(?:<[^<>]*>)?((?:[\w\s,:-]|&nbsp;)+)(?:</[^<>]*>)?</span>")
+
+
+def runTimed(fn, html, queue):
+    start = time.perf_counter()
+    fn(html)
+    queue.put(time.perf_counter() - start)
+
+
+def timeout(fn, html, budget):
+    # Runs in a child process so a pattern that backtracks for hours can be stopped after `budget` seconds
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=runTimed, args=(fn, html, queue))
+    p.start()
+    p.join(budget)
+    if p.is_alive():
+        p.terminate()
+        p.join()
+        return None
+    return queue.get()
+
+
+def benchPatterns(folder='./htmls/', size=5 * 1024 * 1024, budget=10):
+    queue = savedFilings(folder)
+    if queue:
+        # Real filings, run through the regex fallbacks as if lxml had failed on them
+        before = sum(cpu(lambda: legacyFallbacks(html), repeat=1) for f, filing, html in queue)
+        after = sum(cpu(lambda: fallbacks(html)) for f, filing, html in queue)
+        print('Saved filings ({}): {:.1f} ms before, {:.1f} ms after'.format(len(queue), before * 1000, after * 1000))
+
+    html = worstCase(size)
+    print('\nWorst case, single line:')
+    t = cpu(lambda: fallbacks(html))
+    print('{:>10} bytes: patterns.py {:.1f} ms'.format(size, t * 1000))
+    n = 16 * 1024
+    while n <= size:
+        t = timeout(legacyFallbacks, worstCase(n), budget)
+        if t is None:
+            print('{:>10} bytes: old patterns gave up after {} s'.format(n, budget))
+            break
+        print('{:>10} bytes: old patterns {:.1f} ms'.format(n, t * 1000))
+        n *= 2
+
+    html = loneSpan(size)
+    print('\nWorst case, one unclosed <span>:')
+    t = cpu(lambda: fallbacks(html))
+    print('{:>10} bytes: patterns.py {:.1f} ms'.format(size, t * 1000))
+    n = 16 * 1024
+    while n <= size:
+        t = timeout(nestedBoldSpan.findall, loneSpan(n), budget)
+        if t is None:
+            print('{:>10} bytes: nested scans gave up after {} s'.format(n, budget))
+            break
+        print('{:>10} bytes: nested scans {:.1f} ms'.format(n, t * 1000))
+        n *= 2
+
+
+def legacySelectorScan(doc):
+    # getTitleByDiv before the lazy scan: every candidate listed up front and a 16-way selector per candidate
+    selectors = ', '.join('{}[style*="font-weight{}{}"]'.format(e, sep, v) for e in ['span', 'font'] for v in ['bold', '700'] for sep in [':', ': ']) + ', b'
+    elem = None
+    i = 0
+    for a in [x for x in doc.d.items('div, p, td')]:
+        if not a.text().strip():
+            continue
+        if i > 50:
+            break
+        i += 1
+        if not a.find(selectors) and 'font: bold' not in (a.attr('style') or ''):
+            continue
+        if not patterns.fiscalTitle.search(a.text().strip()):
+            continue
+        elem = a
+        break
+    if not elem:
+        return ''
+    s = patterns.fiscalTitle.search(elem.text().replace('\n', ' '))
+    return s.group(0) if s else ''
+
+
+def benchTitle(folder='./htmls/'):
+    s = Scrape.__new__(Scrape)
+    queue = savedFilings(folder)
+    if not queue:
+        print('No saved filings found in {}'.format(folder))
+        return
+    print('{:<60} {:>10} {:>10} {:>8}'.format('Filing', 'Before ms', 'After ms', 'Speedup'))
+    for f, filing, html in queue:
+        doc = Document(html)
+        if doc.d is None:
+            continue
+        b = cpu(lambda: legacySelectorScan(doc), repeat=1)
+        a = cpu(lambda: s.getTitleByDiv(doc))
+        if legacySelectorScan(doc) != s.getTitleByDiv(doc):
+            print('-- Err: titles differ for {}'.format(f))
+        print('{:<60} {:>10.1f} {:>10.1f} {:>7.1f}x'.format(os.path.basename(f)[:60], b * 1000, a * 1000, b / a if a else 0))
+
+
+def benchWrite(sheets=200, rows=40):
+    # Synthetic extract.py style tables: a line item column and yearly columns of numbers with gaps.
+    # Wall time, since most of the work is zipping the workbook to disk.
+    rng = np.random.default_rng(0)
+    tables = {}
+    for n in range(sheets):
+        df = pd.DataFrame(rng.integers(-10 ** 6, 10 ** 6, size=(rows, 4)).astype(float), columns=['2019', '2018', '2017', '2016'])
+        df[df > 9 * 10 ** 5] = np.nan
+        df.insert(0, 'Title', ['Line item {}'.format(i) for i in range(rows)])
+        tables[str(n)] = df
+    for name, fast in [('pandas', False), ('fast', True)]:
+        workbookName = 'bench-write-{}'.format(name)
+        start = time.perf_counter()
+        write.xlsx(tables, companyName='Bench', workbookName=workbookName, fast=fast)
+        t = time.perf_counter() - start
+        size = os.path.getsize(workbookName + '.xlsx')
+        os.remove(workbookName + '.xlsx')
+        print('{:<8} {} sheets: {:.2f} s, {:.0f} KB'.format(name, sheets, t, size / 1024))
+
+
+def benchColumnar(n=5000):
+    # Reading filings metadata back: the scrape workbook through pandas against the Parquet dataset
+    rng = np.random.default_rng(0)
+    rows = [{
+        'date': 43466 + int(d),
+        'quarter': int(q) or None,
+        'reference': '2019-Q{}'.format(q) if q else 2019,
+        'type': '10-Q' if q else '10-K',
+        'title': 'For the quarterly period ended March 31, 2019',
+        'pages': int(p),
+        'index': 'https://www.sec.gov/Archives/edgar/data/{}-index.htm'.format(i),
+        'source': 'https://www.sec.gov/Archives/edgar/data/{}.htm'.format(i)
+    } for i, (d, q, p) in enumerate(zip(rng.integers(0, 365, n), rng.integers(0, 4, n), rng.integers(1, 300, n)))]
+    folder = tempfile.mkdtemp()
+    try:
+        df = pd.DataFrame(rows)
+        write.xlsx({ 'Bench 10-Q': df }, workbookName='bench-columnar')
+        for code in ['10-K', '10-Q']:
+            columnar.write(columnar.filings([r for r in rows if r['type'] == code], 'Bench', code, '0000000000'), folder)
+        start = time.perf_counter()
+        pd.read_excel('bench-columnar.xlsx', header=7)
+        excel = time.perf_counter() - start
+        start = time.perf_counter()
+        back = columnar.read(folder, company='Bench')
+        parquet = time.perf_counter() - start
+        print('{} filings: read_excel {:.1f} ms, Parquet {:.1f} ms ({} rows)'.format(n, excel * 1000, parquet * 1000, len(back)))
+    finally:
+        os.remove('bench-columnar.xlsx')
+        shutil.rmtree(folder)
+
+
+def peak():
+    # Peak resident set size of this process in MB; ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def isolated(fn, *args):
+    # Runs fn(*args), which returns a dict, in a fresh interpreter so its peak RSS isn't the parent's
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=runIsolated, args=(queue, fn, args))
+    p.start()
+    while True:
+        # Polled, so a child that dies without putting anything on the queue can't leave this waiting forever
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if p.exitcode is not None:
+                result = { 'error': 'exited with code {}'.format(p.exitcode) }
+                break
+    p.join()
+    if 'error' in result:
+        raise RuntimeError('{} failed: {}'.format(fn.__name__, result['error']))
+    return result
+
+
+def runIsolated(queue, fn, args):
+    try:
+        result = fn(*args)
+        result['peakMB'] = peak()
+    except Exception:
+        result = { 'error': traceback.format_exc() }
+    queue.put(result)
+
+
+def runScrape(base, out):
+    # Scrape.run for every configured company against the replay server, without the cache, catalog or other side outputs
+    import scrape
+    from fetch import Client
+    scrape.base = base
+    scrape.client = Client(concurrency=scrape.maxConcurrency, headers={ 'User-Agent': scrape.userAgent }, rate=10000, retries=0)
+    scrape.outFolder = os.path.join(out, 'data/')
+    scrape.outHTMLFolder = os.path.join(out, 'htmls/')
+    scrape.workbookName = os.path.join(out, 'bench')
+    scrape.incremental = False
+    scrape.catalog = None
+    scrape.parquetFolder = ''
+    scrape.metricsPath = ''
+    scrape.journalPath = ''
+    start = time.perf_counter()
+    asyncio.run(scrape.main())
+    seconds = time.perf_counter() - start
+    filings = len(glob(os.path.join(out, 'htmls', '*', '*.html')))
+    return {
+        'seconds': seconds,
+        'filings': filings,
+        'filingsPerSecond': filings / seconds,
+        'requests': scrape.client.stats['requests'],
+        'requestsPerSecond': scrape.client.stats['requests'] / seconds,
+        'MBPerSecond': scrape.client.stats['bytes'] / seconds / 1024 ** 2
+    }
+
+
+def runCorpus(folder, out):
+    # Extract and write.xlsx over a fixed set of saved filings, one after the other
+    queue = sorted(y for x in os.walk(folder) for y in glob(os.path.join(x[0], '*.html')))
+    size = sum(os.path.getsize(f) for f in queue)
+    extracted = []
+    start = time.perf_counter()
+    for f in queue:
+        n, compiled = extract.extractTables(f, engine=extract.engine)
+        extracted.append(compiled)
+    extractSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for i, compiled in enumerate(extracted):
+        if compiled:
+            write.xlsx({ k: compiled[k] for k in sorted(compiled, key=int) }, workbookName=os.path.join(out, str(i)), fast=extract.fastWrite)
+    xlsxSeconds = time.perf_counter() - start
+    tables = sum(len(c) for c in extracted)
+    return {
+        'files': len(queue),
+        'tables': tables,
+        'extractSeconds': extractSeconds,
+        'extractMBPerSecond': size / 1024 ** 2 / extractSeconds if extractSeconds else 0,
+        'xlsxSeconds': xlsxSeconds,
+        'xlsxTablesPerSecond': tables / xlsxSeconds if xlsxSeconds else 0
+    }
+
+
+def benchSuite(fixtures='./fixtures/', corpus='./bench/htmls/', latency=50, results='./bench/results.jsonl'):
+    run = { 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'latencyMs': latency }
+    try:
+        run['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        pass
+    out = tempfile.mkdtemp()
+    try:
+        if os.path.isdir(fixtures):
+            server = replay.Replay(fixtures, latency / 1000)
+            print('Replaying {} recorded responses with {} ms latency'.format(len(server.responses), latency))
+            run['scrape'] = isolated(runScrape, server.serve(), os.path.join(out, 'scrape'))
+            run['scrape']['missed'] = server.missed
+        else:
+            print('No fixtures in {}: record them by running scrape.py once with cacheFolder = {!r}'.format(fixtures, fixtures))
+        if os.path.isdir(corpus):
+            os.makedirs(os.path.join(out, 'corpus'))
+            run['corpus'] = isolated(runCorpus, corpus, os.path.join(out, 'corpus'))
+        else:
+            print('No corpus in {}'.format(corpus))
+    finally:
+        shutil.rmtree(out)
+
+    previous = None
+    if os.path.exists(results):
+        with open(results, encoding='utf-8') as f:
+            lines = [l for l in f if l.strip()]
+        previous = json.loads(lines[-1]) if lines else None
+    os.makedirs(os.path.dirname(results), exist_ok=True)
+    with open(results, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
+
+    print('\n{:<28} {:>12} {:>12}'.format('', 'This run', 'Previous'))
+    for part in ['scrape', 'corpus']:
+        for k, v in run.get(part, {}).items():
+            before = (previous or {}).get(part, {}).get(k)
+            print('{:<28} {:>12.2f} {:>12}'.format(part + ' ' + k, v, '' if before is None else '{:.2f}'.format(before)))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'parse':
+        benchParse(*args[1:2])
+    elif args and args[0] == 'values':
+        benchValues(*args[1:2], *[int(x) for x in args[2:3]])
+    elif args and args[0] == 'patterns':
+        benchPatterns(*args[1:2], *[int(x) for x in args[2:3]])
+    elif args and args[0] == 'title':
+        benchTitle(*args[1:2])
+    elif args and args[0] == 'write':
+        benchWrite(*[int(x) for x in args[1:2]])
+    elif args and args[0] == 'columnar':
+        benchColumnar(*[int(x) for x in args[1:2]])
+    elif args and args[0] == 'suite':
+        benchSuite(*args[1:3], *[int(x) for x in args[3:4]])
+    else:
+        print('Usage: python bench.py parse|values|patterns|title [folder] | write [sheets] | columnar [filings] | suite [fixtures] [corpus] [latency ms]')
@@ -0,0 +1,91 @@
+import sqlite3
+
+
+# Persistent record of every filing scrape.py has kept, across companies and runs.
+# One row per accession, upserted so a re-run refreshes titles and paths instead of duplicating them.
+# Reports can be rebuilt from it with `python scrape.py --report`, without touching the network or the HTML.
+
+columns = ['accession', 'cik', 'company', 'type', 'date', 'quarter', 'reference', 'title', 'pages', 'index', 'source']
+
+schema = '''
+CREATE TABLE IF NOT EXISTS filings (
+    accession TEXT PRIMARY KEY,
+    cik TEXT NOT NULL,
+    company TEXT,
+    type TEXT NOT NULL,
+    date TEXT NOT NULL,
+    quarter INTEGER,
+    reference TEXT,
+    title TEXT,
+    pages INTEGER,
+    "index" TEXT,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS filings_cik_type_date ON filings (cik, type, date);
+CREATE INDEX IF NOT EXISTS filings_reference ON filings (reference);
+'''
+
+
+class Catalog:
+
+    def __init__(self, path='./catalog.sqlite'):
+        self.path = path
+        self.db = None
+
+    def open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.row_factory = sqlite3.Row
+            self.db.executescript(schema)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+
+    def upsert(self, cik, company, rows):
+        # Rows as Scrape.parse returns them, still carrying their private _accession and _datetime keys.
+        # The whole batch goes in one transaction.
+        values = [(
+            row['_accession'],
+            cik,
+            company,
+            row['type'],
+            row['_datetime'].date().isoformat(),
+            row.get('quarter'),
+            None if row.get('reference') in [None, ''] else str(row['reference']),
+            row.get('title'),
+            row.get('pages'),
+            row['index'],
+            row.get('source')
+        ) for row in rows if '_accession' in row]
+        if not values:
+            return 0
+        db = self.open()
+        with db:
+            db.executemany(
+                'INSERT INTO filings ({}) VALUES ({}) ON CONFLICT(accession) DO UPDATE SET {}'.format(
+                    ', '.join('"{}"'.format(c) for c in columns),
+                    ', '.join('?' for c in columns),
+                    ', '.join('"{0}" = excluded."{0}"'.format(c) for c in columns[1:])
+                ),
+                values
+            )
+        return len(values)
+
+    def filings(self, cik, types=[], datestart='', dateend=''):
+        # Newest first, like the browse-edgar feed. Served by the (cik, type, date) index.
+        query = 'SELECT * FROM filings WHERE cik = ?'
+        params = [cik]
+        if types:
+            query += ' AND type IN ({})'.format(', '.join('?' for t in types))
+            params += list(types)
+        if datestart:
+            query += ' AND date >= ?'
+            params.append(datestart)
+        if dateend:
+            query += ' AND date <= ?'
+            params.append(dateend)
+        query += ' ORDER BY date DESC, accession DESC'
+        return [dict(r) for r in self.open().execute(query, params)]
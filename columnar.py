@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+
+# Typed Parquet output next to the Excel workbooks, for loading results back into pandas without going through xlsx.
+# Datasets are hive partitioned by company and form code (company=.../code=.../part-0.parquet), and a re-run replaces
+# only the partitions it writes. Every partition has the same schema, so a whole dataset reads back as one table.
+
+filingSchema = pa.schema([
+    ('company', pa.string()),
+    ('code', pa.string()),
+    ('cik', pa.string()),
+    ('date', pa.date32()),
+    ('quarter', pa.int8()),
+    ('reference', pa.string()),
+    ('type', pa.string()),
+    ('title', pa.string()),
+    ('pages', pa.int32()),
+    ('index', pa.string()),
+    ('source', pa.string())
+])
+
+# extract.py tables in long form: one row per cell, keyed by file, table and position
+tableSchema = pa.schema([
+    ('company', pa.string()),
+    ('code', pa.string()),
+    ('file', pa.string()),
+    ('table', pa.int32()),
+    ('name', pa.string()),
+    ('page', pa.int32()),
+    ('currency', pa.string()),
+    ('row', pa.int32()),
+    ('item', pa.string()),
+    ('column', pa.string()),
+    ('value', pa.float64()),
+    ('text', pa.string())
+])
+
+partitioning = ds.partitioning(pa.schema([('company', pa.string()), ('code', pa.string())]), flavor='hive')
+
+
+def filings(rows, company='', code='', cik=''):
+    # Scrape rows as an Arrow table. Dates come in as the Excel serials getDate makes; references are
+    # an int year for annual filings and 'YYYY-Qn' otherwise, so both are stored as strings.
+    df = pd.DataFrame(rows, columns=[f.name for f in filingSchema if f.name not in ['company', 'code', 'cik']])
+    df['date'] = pd.to_datetime(df['date'], unit='D', origin='1899-12-30').dt.date
+    # Taken from the dicts: once in the frame a column of years and blanks is float, and would read back as '2018.0'
+    df['reference'] = [None if r.get('reference') in (None, '') else str(r['reference']) for r in rows]
+    df['quarter'] = df['quarter'].astype('Int8')
+    df['pages'] = df['pages'].astype('Int32')
+    df.insert(0, 'company', company)
+    df.insert(1, 'code', code)
+    df.insert(2, 'cik', cik)
+    return pa.Table.from_pandas(df, schema=filingSchema, preserve_index=False)
+
+
+def tables(compiled, company='', code='', file=''):
+    # extract.py's {table number: Extract} for one file as a long table. The first column of each table holds
+    # the line items; every other cell becomes a row with its numeric value, or its text when it isn't a number.
+    out = { f.name: [] for f in tableSchema }
+    for k, meta in compiled.items():
+        df = meta.data
+        columns = [str(c) for c in df.columns]
+        for r, row in enumerate(df.itertuples(index=False, name=None)):
+            for c in range(1, len(row)):
+                v = row[c]
+                number = isinstance(v, (int, float, np.number)) and not isinstance(v, bool)
+                out['company'].append(company)
+                out['code'].append(code)
+                out['file'].append(file)
+                out['table'].append(int(k))
+                out['name'].append(meta.name)
+                out['page'].append(meta.page or None)
+                out['currency'].append(meta.currency or None)
+                out['row'].append(r)
+                out['item'].append(None if row[0] is None else str(row[0]))
+                out['column'].append(columns[c])
+                out['value'].append(float(v) if number else None)
+                out['text'].append(None if number or v is None or v == '' else str(v))
+    return pa.Table.from_pydict(out, schema=tableSchema)
+
+
+def write(table, folder, name=''):
+    # Without a name the partitions being written are replaced outright, which suits one table per company and code.
+    # Several files sharing a partition (extract.py's) are each written under their own name instead, so a re-run
+    # of one file overwrites only its own part.
+    ds.write_dataset(
+        table,
+        folder,
+        format='parquet',
+        partitioning=partitioning,
+        basename_template=(name.replace('/', '_') or 'part') + '-{i}.parquet',
+        existing_data_behavior='overwrite_or_ignore' if name else 'delete_matching'
+    )
+
+
+def read(folder, company=None, code=None, schema=filingSchema):
+    # Reads a dataset back into pandas. company and code prune partitions, so only the matching files are opened.
+    dataset = ds.dataset(folder, format='parquet', partitioning=partitioning, schema=schema)
+    condition = None
+    for field, value in [('company', company), ('code', code)]:
+        if value is None:
+            continue
+        term = ds.field(field) == value
+        condition = term if condition is None else condition & term
+    return dataset.to_table(filter=condition).to_pandas()
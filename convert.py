@@ -1,32 +1,108 @@
 import os
+import sys
+import shutil
+import subprocess
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pdfkit
 from decimal import Decimal
 from pathlib import Path
 
-# You need to have the wkhtmltopdf.exe executable in this folder.
-# Alternatively, add it to your PATH variables and comment out the config = line
+# Converts every saved filing under fromdir to a PDF under outdir with wkhtmltopdf.
+# The binary is --wkhtmltopdf, else $WKHTMLTOPDF, else wkhtmltopdf on the PATH, else ./wkhtmltopdf.exe in this folder.
+# Usage: python convert.py [--from ./htmls/] [--out ./pdfs/] [--workers n] [--timeout seconds] [--wkhtmltopdf path]
 
 fromdir = './htmls/'
 outdir = './pdfs/'
+workers = os.cpu_count() or 1       # wkhtmltopdf processes running at once. Each is mostly waiting on its own rendering
+timeout = 300                       # Seconds before a conversion is killed, so one hung page can't stall the batch
+wkhtmltopdf = os.environ.get('WKHTMLTOPDF') or shutil.which('wkhtmltopdf') or './wkhtmltopdf.exe'
+options = { 'enable-local-file-access': None }
 
-Path(outdir).mkdir(parents=True, exist_ok=True)
 
-config = pdfkit.configuration(wkhtmltopdf='./wkhtmltopdf.exe')
+def target(f):
+	return f.replace(fromdir, outdir).replace('.html', '.pdf')
 
-queue = [y for x in os.walk(fromdir) for y in glob(os.path.join(x[0], '*.html'))]
 
-for i, f in enumerate(queue):
-	f = f.replace('\\', '/')
-	fDir = '/'.join(f.split('/')[:-1]).replace(fromdir, outdir) + '/'
-	os.makedirs(fDir, exist_ok=True)
+def upToDate(f, out):
+	# A PDF at least as new as its HTML was converted from this version of it
 	try:
-		pdfkit.from_file(
-			f,
-			f.replace(fromdir, outdir).replace('.html', '.pdf'),
-			options = { 'enable-local-file-access': None },
-			configuration = config
-		)
-	except Exception as e:
-		print(e)
-	print('Completed: {}%. Converted: {}'.format(int(i / len(queue) * 100), f))
\ No newline at end of file
+		return os.path.getmtime(out) >= os.path.getmtime(f)
+	except OSError:
+		return False
+
+
+def pdfkitConverter(binary=wkhtmltopdf, seconds=timeout):
+	# pdfkit builds the wkhtmltopdf command line; it is run here rather than by pdfkit so it can be killed on timeout.
+	# Any callable taking (html path, pdf path) can stand in for this one, e.g. to test the pool without wkhtmltopdf.
+	config = pdfkit.configuration(wkhtmltopdf=binary)
+
+	def convert(f, out):
+		args = pdfkit.PDFKit(f, 'file', options=options, configuration=config).command(out)
+		subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=seconds, check=True)
+
+	return convert
+
+
+def convertFile(f, converter):
+	# Converts to a temporary name first, so a killed or failed conversion never leaves a PDF that looks up to date
+	out = target(f)
+	if upToDate(f, out):
+		return 'skipped'
+	os.makedirs(os.path.dirname(out), exist_ok=True)
+	part = out[:-len('.pdf')] + '.part.pdf'
+	try:
+		converter(f, part)
+		os.replace(part, out)
+	finally:
+		if os.path.exists(part):
+			os.remove(part)
+	return 'converted'
+
+
+def convertAll(queue, converter, workers=workers):
+	# Threads are enough here: each one only waits on its converter's subprocess
+	counts = { 'converted': 0, 'skipped': 0, 'failed': 0 }
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		futures = { pool.submit(convertFile, f, converter): f for f in queue }
+		for i, future in enumerate(as_completed(futures)):
+			f = futures[future]
+			try:
+				status = future.result()
+			except subprocess.TimeoutExpired:
+				status = 'failed'
+				print('Timed out: {}'.format(f))
+			except subprocess.CalledProcessError as e:
+				status = 'failed'
+				print('Failed: {}\n{}'.format(f, (e.stderr or b'').decode('utf-8', errors='replace').strip()))
+			except Exception as e:
+				status = 'failed'
+				print('Failed: {}\n{}'.format(f, e))
+			counts[status] += 1
+			print('Completed: {}%. {}: {}'.format(int((i + 1) / len(queue) * 100), status.capitalize(), f))
+	return counts
+
+
+def option(name, default):
+	if name in sys.argv[1:-1]:
+		return type(default)(sys.argv[sys.argv.index(name) + 1])
+	return default
+
+
+def main():
+	global fromdir, outdir, workers, timeout, wkhtmltopdf
+	fromdir = option('--from', fromdir)
+	outdir = option('--out', outdir)
+	workers = option('--workers', workers)
+	timeout = option('--timeout', timeout)
+	wkhtmltopdf = option('--wkhtmltopdf', wkhtmltopdf)
+
+	Path(outdir).mkdir(parents=True, exist_ok=True)
+	queue = [y.replace('\\', '/') for x in os.walk(fromdir) for y in glob(os.path.join(x[0], '*.html'))]
+	counts = convertAll(queue, pdfkitConverter(wkhtmltopdf, timeout), workers)
+	print('\nConverted: {converted}, up to date: {skipped}, failed: {failed}'.format(**counts))
+	return counts['failed']
+
+
+if __name__ == '__main__':
+	sys.exit(1 if main() else 0)
@@ -0,0 +1,200 @@
+import re
+import lxml.html
+import lxml.etree
+from pyquery import PyQuery as pq
+from patterns import fiscalTitle
+
+
+# A downloaded filing parsed once with lxml.html and shared by getTitle, getPages and the title helpers.
+# Documents lxml cannot parse keep only their raw HTML, and the extractors fall back to their regex paths.
+
+class Document:
+
+    def __init__(self, html='', parse=True):
+        self.html = html
+        self.root = None
+        self.d = None
+        if not parse:
+            return
+        try:
+            self.root = lxml.html.fromstring(html)
+        except (lxml.etree.ParserError, lxml.etree.XMLSyntaxError, ValueError):
+            return
+        self.d = pq(self.root)
+
+
+# Streaming counterpart of Document for filings too large to hold as a tree.
+# Chunks of HTML go through lxml's event parser and only the counters and a small text window per open
+# div/p/td are kept, so memory stays flat however large the filing is. It follows the same rules as
+# getPages, getTitleByP and getTitleByDiv; text is squashed the way PyQuery's .text() does it.
+
+squash = re.compile('[\x20\x09\x0C\u200B\x0A\x0D]+')
+pageBreakStyles = ['page-break-before:always', 'page-break-after:always', 'page-break-before: always', 'page-break-after: always']
+boldStyles = ['font-weight:bold', 'font-weight: bold', 'font-weight:700', 'font-weight: 700']
+titleExcludes = ['exhibit', 'united states', 'securities and exchange commission', 'washington, d.c. 20549']
+# getTitleByDiv's bold test in one compiled query: a <b>, or a span/font styled bold, anywhere below the element
+hasBold = lxml.etree.XPath('boolean(descendant::b | descendant::*[(self::span or self::font) and ({})])'.format(
+    ' or '.join("contains(@style, '{}')".format(s) for s in boldStyles)
+))
+blockTags = ['address', 'article', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul']
+
+
+class Candidate:
+
+    # One open div, p or td. Keeps the first `limit` characters for paragraph titles and a sliding
+    # window that is searched for the fiscal period title as text arrives.
+    limit = 4096
+    window = 4096
+    overlap = 256
+
+    def __init__(self, tag='', order=0, style=''):
+        self.tag = tag
+        self.order = order
+        self.rank = None
+        self.paragraph = None
+        self.bold = False
+        self.hasB = False
+        self.ownBold = 'font: bold' in style
+        self.head = ''
+        self.tail = ''
+        self.match = None
+
+    def add(self, text):
+        if len(self.head) < self.limit:
+            self.head += text[:self.limit - len(self.head)]
+        if self.match is not None:
+            return
+        self.tail += text
+        if len(self.tail) > self.window:
+            self.search()
+            self.tail = self.tail[-self.overlap:]
+
+    def search(self):
+        if self.match is None:
+            s = fiscalTitle.search(squash.sub(' ', self.tail))
+            if s:
+                self.match = s.group(0)
+        return self.match
+
+    def text(self):
+        return squash.sub(' ', self.head).strip()
+
+
+class StreamExtract:
+
+    def __init__(self, filingType='', stopEarly=False, pageBreakSize=3):
+        self.filingType = filingType
+        self.stopEarly = stopEarly
+        self.pageBreakSize = str(pageBreakSize)
+        self.breaks = 0
+        self.hrs = 0
+        self.stack = []
+        self.open = []
+        self.order = 0
+        self.ranked = 0
+        self.paragraphs = 0
+        self.titleByP = None
+        self.titleByDiv = None
+        self.titleOrder = None
+        self.done = False
+        self.closed = False
+        self.parser = lxml.etree.HTMLParser(target=self)
+
+    @property
+    def pages(self):
+        return self.breaks or self.hrs
+
+    def title(self, filingType=''):
+        if (filingType or self.filingType) == '6-K' and self.titleByP:
+            return self.titleByP
+        return self.titleByDiv or ''
+
+    def feed(self, html):
+        if self.done:
+            return
+        self.parser.feed(html)
+        if self.stopEarly and self.settled():
+            self.done = True
+
+    def finish(self):
+        if not self.closed:
+            self.closed = True
+            self.parser.close()
+        return self
+
+    def settled(self):
+        if self.filingType == '6-K' and self.titleByP:
+            return True
+        if self.filingType == '6-K' and self.titleByP is None:
+            return False
+        # An open ancestor that is still within the first 51 candidates could yet match, and it would win
+        if any(c.rank is not None and c.rank <= 51 for c in self.open):
+            return False
+        return self.titleByDiv is not None or self.ranked > 51
+
+    # lxml parser target callbacks
+
+    def start(self, tag, attrib):
+        style = attrib.get('style', '')
+        if any(s in style for s in pageBreakStyles):
+            self.breaks += 1
+        if tag == 'hr' and (attrib.get('size') == self.pageBreakSize or 'noshade' in attrib):
+            self.hrs += 1
+        if tag == 'b' or (tag in ['span', 'font'] and any(s in style for s in boldStyles)):
+            for c in self.open:
+                c.bold = True
+                c.hasB = c.hasB or tag == 'b'
+        if tag in blockTags:
+            for c in self.open:
+                c.add('\n')
+        c = None
+        if tag in ['div', 'p', 'td']:
+            c = Candidate(tag, self.order, style)
+            self.order += 1
+            if tag == 'p':
+                c.paragraph = self.paragraphs
+                self.paragraphs += 1
+                if c.paragraph > 10 and self.titleByP is None:
+                    self.titleByP = ''
+            self.open.append(c)
+        self.stack.append(c)
+
+    def end(self, tag):
+        if tag in blockTags:
+            for c in self.open:
+                c.add('\n')
+        if not self.stack:
+            return
+        c = self.stack.pop()
+        if c is None:
+            return
+        self.open.pop()
+        if c.paragraph is not None and c.paragraph <= 10 and self.titleByP is None:
+            text = c.text()
+            if c.hasB and text and not any(s in text.lower() for s in titleExcludes):
+                self.titleByP = text
+            elif c.paragraph == 10:
+                self.titleByP = ''
+        if c.rank is not None and c.rank <= 51 and (c.bold or c.ownBold):
+            if self.titleOrder is None or c.order < self.titleOrder:
+                m = c.search()
+                if m:
+                    self.titleByDiv = m
+                    self.titleOrder = c.order
+
+    def data(self, text):
+        if not self.open:
+            return
+        nonblank = bool(text.strip())
+        for c in self.open:
+            if nonblank and c.rank is None:
+                self.ranked += 1
+                c.rank = self.ranked
+            c.add(text)
+
+    def close(self):
+        if self.titleByP is None:
+            self.titleByP = ''
+        if self.titleByDiv is None:
+            self.titleByDiv = ''
+        return self
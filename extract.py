@@ -1,114 +1,234 @@
 
 import os
+import sys
 from glob import glob
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import pandas as pd
 import lxml.etree
+import lxml.html
 from bs4 import BeautifulSoup
 import re
 from write import xlsx
+import columnar
 from decimal import Decimal
 from pathlib import Path
 import itertools
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+# Parity check of the two engines: python extract.py --parity --from ./parity/
+# ./parity/ holds small saved filings with page markers, bold table names and currency cells; the run exits 1 on any difference.
 
 fromdir = './htmls/Canadian/'
 outdir = './xlsx/'
+workers = os.cpu_count() or 1       # Processes converting files in parallel
+splitSize = 5 * 1024 * 1024         # Files larger than this (bytes) are parsed once and their tables shared out across all workers. 0 disables
+engine = 'bs4'                      # 'bs4' parses with BeautifulSoup's html.parser, 'lxml' walks the tables with lxml XPath
+fastWrite = True                    # Write workbooks with write.xlsxFast, streaming rows with xlsxwriter instead of going through pandas
+parquetdir = './parquet/tables/'    # Every table cell in long form, partitioned by company and form code (see columnar.py). '' disables
 
-Path(outdir).mkdir(parents=True, exist_ok=True)
-
-queue = [y for x in os.walk(fromdir) for y in glob(os.path.join(x[0], '*.html'))]
 regexes = {
     'year': re.compile(r"(?:2\s?0|1\s?9)\s?[0-9]\s?[0-9]$"),
     'currency': re.compile(r"^[$£]$")
 }
+suffixes = [')', '%', ')%']
+currencies = ['$', '£']            # Every string regexes['currency'] matches
+suffixSet = set(suffixes)
+currencySet = set(currencies)
+numberStart = set('0123456789+-.iInN')    # First characters of what float() takes, apart from non-ASCII digits
+
+# The two parsing engines hand Extract the same things: an Index of the document, and each table as a list
+# of (row text, [(cell text, colspan), ...]) rows with every string already stripped.
+
+stringValue = lxml.etree.XPath('string()')
+cellPath = lxml.etree.XPath('.//th | .//td')
+
+
+def span(v):
+    try:
+        return max(1, int(v))
+    except (TypeError, ValueError):
+        return 1
+
+
+def soupRows(table):
+    rows = []
+    for row in table.find_all('tr'):
+        cells = [(x.text.strip(), span(x.get('colspan'))) for x in row.select('th, td')]
+        rows.append((row.text.strip(), cells))
+    return rows
+
+
+def lxmlRows(table):
+    rows = []
+    for row in table.iter('tr'):
+        cells = [(stringValue(x).strip(), span(x.get('colspan'))) for x in cellPath(row)]
+        rows.append((stringValue(row).strip(), cells))
+    return rows
+
+
+def soupIndex(soup):
+    return Index(((tag.name, tag) for tag in soup.find_all(True)), lambda tag: tag.text)
+
+
+def lxmlIndex(root):
+    return Index(((e.tag, e) for e in root.iter() if isinstance(e.tag, str)), stringValue)
+
+
+class Index:
+
+    # One linear pass over a document recording where every <hr>, <p> and <b> sits in document order.
+    # findPage and findName binary search these instead of walking backwards from every table. Texts are only
+    # read when a lookup reaches them: html.parser nests unclosed <p>s, so one <p>'s text can run to the end of
+    # the document, and reading every one up front would be quadratic.
+    def __init__(self, elements, text):
+        self.text = text
+        self.position = {}
+        self.hrs = []
+        self.hrPositions = []
+        self.ps = []
+        self.pPositions = []
+        self.bs = []
+        self.bPositions = []
+        self.texts = {}
+        for i, (name, tag) in enumerate(elements):
+            self.position[id(tag)] = i
+            if name == 'hr':
+                self.hrs.append(tag)
+                self.hrPositions.append(i)
+            elif name == 'p':
+                self.ps.append(tag)
+                self.pPositions.append(i)
+            elif name == 'b':
+                self.bs.append(tag)
+                self.bPositions.append(i)
+
+    def nextHr(self, tag):
+        i = bisect_right(self.hrPositions, self.position[id(tag)])
+        return self.hrs[i] if i < len(self.hrs) else None
+
+    def countHrBefore(self, tag):
+        return bisect_left(self.hrPositions, self.position[id(tag)])
+
+    def previous(self, tags, positions, tag, strip):
+        # Walks back from the nearest tag before this one to the first whose text is not empty
+        for i in range(bisect_left(positions, self.position[id(tag)]) - 1, -1, -1):
+            t = self.texts.get(id(tags[i]))
+            if t is None:
+                t = self.text(tags[i])
+                t = self.texts[id(tags[i])] = t.strip() if strip else t
+            if t:
+                return t
+        return None
+
+    def previousP(self, tag):
+        # Text of the nearest <p> before the tag whose text is not empty
+        return self.previous(self.ps, self.pPositions, tag, False)
+
+    def previousB(self, tag):
+        # Stripped text of the nearest <b> before the tag whose stripped text is not empty
+        return self.previous(self.bs, self.bPositions, tag, True)
+
 
 class Extract:
 
-    def __init__(self, table, name='', source='', preHeader=[''], columns=[''], length=0, postHeader = []):
-        self.name = name + self.findName(table)
+    def __init__(self, table, name='', source='', preHeader=None, columns=None, length=0, postHeader=None, index=None, rows=None, page=None):
+        # Without an index or rows, table is taken to be a BeautifulSoup tag. With table None, the name, page and
+        # rows come ready made from readTables
+        if table is not None:
+            if index is None:
+                index = soupIndex(list(table.parents)[-1] if table.parent else table)
+            if rows is None:
+                rows = soupRows(table)
+            name += self.findName(table, index)
+            page = self.findPage(table, index)
+        self.name = name
         self.source = source
-        self.page = self.findPage(table)
-        self.preHeader = preHeader
+        self.page = page
+        self.preHeader = [''] if preHeader is None else preHeader
+        self.columns = [''] if columns is None else columns
         self.length = length
-        self.postHeader = postHeader
+        self.postHeader = [] if postHeader is None else postHeader
         self.currency = ''
         self.raw = []
         self.data = None
         
-        dateRow = self.findDates(table)
+        dateRow = self.findDates(rows)
         if dateRow == -1:
             return
 
-        rows = table.find_all('tr')
         whilePost = True
         lineBreak = False
-        for i, row in enumerate(rows):
+        for i, (text, cells) in enumerate(rows):
             if i < dateRow:
-                self.preHeader.append(row.text.strip())
+                self.preHeader.append(text)
                 continue
-            cells = row.select('th, td')
-            values = [x.text.strip() for x in cells]
+            values = [v for v, colspan in cells]
             if i == dateRow:
-                self.columns = []
-                for j, v in enumerate(values):
-                    cell = cells[j]
-                    self.columns.append(v)
-                    if 'colspan' in cell:
-                        for _ in itertools.repeat(None, int(cell['colspan'])):
-                            self.columns.append('')
+                # One column per header cell. Data rows aren't widened by their colspans either, so widening
+                # only the header would leave the DataFrame with more columns than any row has values.
+                self.columns = list(values)
                 self.length += len(self.columns)
                 for j in range(0, len(self.columns) - self.length):
                     self.columns.append('')
                 continue
             if not values[0] and whilePost:
-                self.postHeader.append(row.text.strip())
+                self.postHeader.append(text)
                 continue
             
-            parsed = self.parseValues(values)
             if not len(values) or all([(not x) for x in values]):
                 lineBreak = True
             elif lineBreak:
                 self.raw.append([] * length)
                 lineBreak = False
 
-            self.raw.append(parsed)
+            self.raw.append(values)
             for _  in itertools.repeat(None, len(values) - len(self.columns)):
                 self.columns.append('')
 
+        self.raw = self.parseTable(self.raw)
         if self.currency:
             self.name += ' ({})'.format(self.currency)
         df = pd.DataFrame(self.raw, columns=self.columns)
         self.data = df
 
+    def parseTable(self, rows):
+        # Cleans every row with parseValues and records the table's most common currency symbol as self.currency
+        symbols = Counter(v for r in rows for v in r if v in currencySet)
+        if symbols:
+            self.currency = symbols.most_common(1)[0][0]
+        return [self.parseValues(r) for r in rows]
+
     def parseValues(self, values):
-        parsed = [None] * len(values)
+        # ')' and '%' fragments join the previous cell when it holds something and currency symbols are dropped.
+        # Then parentheses become a minus sign, commas go, a lone dash is zero and anything float() takes is a float.
+        # Only strings that can start a number go through float(), so labels don't each cost an exception.
         mware = [None] * len(values)
         for i, v in enumerate(values):
             if not v:
-                parsed[i] = v
                 continue
-            if (v == ')' or v == '%' or v == ')%') and mware[i - 1]:
+            if v in suffixSet and mware[i - 1]:
                 mware[i - 1] += v
-            elif regexes['currency'].match(v):
+            elif v in currencySet:
                 pass
             else:
-                if not mware[i]:
-                    mware[i] = ''
-                mware[i] += v
-        for i, v in enumerate(mware):
-            if not v:
-                parsed[i] = v
-                continue
-            if v.startswith('(') and v.endswith(')'):
-                v = '-' + v[1:-1]
-            v = v.replace(',', '')
-            if v == '—':
-                parsed[i] = 0
-                continue
-            try:
-                parsed[i] = float(v)
-            except:
-                parsed[i] = v
+                mware[i] = v
+        parsed = []
+        for v in mware:
+            if v:
+                if v[0] == '(' and v[-1] == ')':
+                    v = '-' + v[1:-1]
+                if ',' in v:
+                    v = v.replace(',', '')
+                if v == '—':
+                    v = 0
+                elif v and (v[0] in numberStart or not v[0].isascii()):
+                    try:
+                        v = float(v)
+                    except ValueError:
+                        pass
+            parsed.append(v)
         return parsed
 
     def parseCurrency(self, values):
@@ -117,67 +237,215 @@ class Extract:
                 return v
         return ''
 
-    def findPage(self, table):     
-        hr = table.find_next('hr')
-        if hr:
-            pageDiv = hr.find_previous('p')
-            while not pageDiv.text:
-                pageDiv = pageDiv.find_previous('p')
-            if pageDiv.text.isnumeric():
-                return int(pageDiv.text)
-        x = len(table.find_all_previous('hr'))
+    @staticmethod
+    def findPage(table, index):
+        hr = index.nextHr(table)
+        # Not `if hr`: an lxml element without children is falsy
+        if hr is not None:
+            # None here fails on .isnumeric() exactly where the old backwards walk failed on .text
+            pageDiv = index.previousP(hr)
+            if pageDiv.isnumeric():
+                return int(pageDiv)
+        x = index.countHrBefore(table)
         if x:
             return x
         return None
 
-    def findName(self, table):
-        b = table.find_previous('b')
-        while b:
-            t = b.text.strip()
-            if not t:
-                pass
-            elif t.startswith('(') and t.startswith(')'):
-                pass
-            else:
-                return t
-            b = b.find_previous('b')
-        self.name = table.find_previous('b').text.strip()
+    @staticmethod
+    def findName(table, index):
+        # '' without a <b> before the table, so the whole and split paths name it alike
+        return index.previousB(table) or ''
 
 
     ## Header
-    def findDates(self, table):
-        rows = table.find_all('tr')
-        for i, row in enumerate(rows):
-            cells = row.select('th, td')
-            values = [x.text.strip() for x in cells if x.text.strip()]
+    def findDates(self, rows):
+        for i, (text, cells) in enumerate(rows):
+            values = [v for v, colspan in cells if v]
             if len(values) and all([regexes['year'].search(v) and len(v) < 15 for v in values]):
                 return i
         return -1
 
 
-for i, f in enumerate(queue):
-    f = f.replace('\\', '/')
-    outDir = '/'.join(f.split('/')[:-1]).replace(fromdir, outdir) + '/'
-    os.makedirs(outDir, exist_ok=True)
-    print('\nExtracting tables from %s...' % (f))
-    try:
-        title = f.split('/')[-1].replace('.html', '')
-        filename = title.split(' - ')
-        [companyName, date, filing] = filename
-        file = open(f)
+def parse(f, engine='bs4'):
+    # A file's tables, its Index and the engine's row reader
+    file = open(f)
+    if engine == 'lxml':
+        # Parsed from utf-8 bytes so a stale <meta charset> in the saved page can't override the encoding
+        root = lxml.html.document_fromstring(file.read().encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+        file.close()
+        tables = list(root.iter('table'))
+        index = lxmlIndex(root)
+        getRows = lxmlRows
+    else:
         soup = BeautifulSoup(file, 'html.parser')
+        file.close()
         tables = soup.find_all('table')
-        compiled = {}
-        for j, table in enumerate(tables):
-            meta = Extract(table)
-            if meta.data is None:
+        index = soupIndex(soup)
+        getRows = soupRows
+    return tables, index, getRows
+
+
+def extractTables(f, engine='bs4'):
+    # Runs in a worker process. Converts every table of one file
+    title = f.split('/')[-1].replace('.html', '')
+    tables, index, getRows = parse(f, engine)
+    compiled = {}
+    for j, table in enumerate(tables):
+        meta = Extract(table, index=index, rows=getRows(table))
+        if meta.data is not None:
+            compiled[str(j)] = named(meta, title)
+    return len(tables), compiled
+
+
+def readTables(f, engine='bs4'):
+    # Runs in a worker process. The parse half of extractTables for a large file: each table's number, name, page and
+    # rows as plain lists, so convertTables can share the rest out across workers that never parse the file themselves
+    tables, index, getRows = parse(f, engine)
+    return len(tables), [(j, Extract.findName(table, index), Extract.findPage(table, index), getRows(table)) for j, table in enumerate(tables)]
+
+
+def convertTables(f, items):
+    # Runs in a worker process. The convert half of extractTables, for some of the tables readTables returned
+    title = f.split('/')[-1].replace('.html', '')
+    compiled = {}
+    for j, name, page, rows in items:
+        meta = Extract(None, name=name, page=page, rows=rows)
+        if meta.data is not None:
+            compiled[str(j)] = named(meta, title)
+    return compiled
+
+
+def named(meta, title):
+    meta.source = title + (', p. ' + str(meta.page) if meta.page else '')
+    return meta
+
+
+def parity(f):
+    # Runs both engines over one file and lists every table where the lxml output differs from BeautifulSoup's
+    diffs = []
+    results = {}
+    for e in ['bs4', 'lxml']:
+        try:
+            results[e] = extractTables(f, engine=e)
+        except Exception as ex:
+            results[e] = (None, '{}: {}'.format(type(ex).__name__, ex))
+    (n, expected), (m, actual) = results['bs4'], results['lxml']
+    if n is None or m is None:
+        if n is not None or m is not None or expected != actual:
+            diffs.append('failed: bs4 {} / lxml {}'.format(expected if n is None else 'ok', actual if m is None else 'ok'))
+        return diffs
+    if n != m:
+        diffs.append('table count: bs4 {} / lxml {}'.format(n, m))
+    for k in sorted(set(expected) | set(actual), key=int):
+        if k not in expected or k not in actual:
+            diffs.append('table {}: only converted by {}'.format(k, 'bs4' if k in expected else 'lxml'))
+            continue
+        a, b = expected[k], actual[k]
+        for attr in ['name', 'page', 'source', 'currency']:
+            if getattr(a, attr) != getattr(b, attr):
+                diffs.append('table {} {}: {!r} / {!r}'.format(k, attr, getattr(a, attr), getattr(b, attr)))
+        if not a.data.equals(b.data):
+            diffs.append('table {}: DataFrames differ'.format(k))
+    return diffs
+
+
+def option(name, default):
+    if name in sys.argv[1:-1]:
+        return type(default)(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+
+def main():
+    global fromdir, outdir, workers, splitSize, engine, parquetdir
+    fromdir = option('--from', fromdir)
+    outdir = option('--out', outdir)
+    workers = option('--workers', workers)
+    splitSize = option('--split', splitSize)
+    engine = option('--engine', engine)
+    parquetdir = option('--parquet', parquetdir)
+
+    queue = [y.replace('\\', '/') for x in os.walk(fromdir) for y in glob(os.path.join(x[0], '*.html'))]
+    if '--parity' in sys.argv[1:]:
+        return checkParity(queue)
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    pending = {}
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for f in queue:
+            try:
+                title = f.split('/')[-1].replace('.html', '')
+                [companyName, date, filing] = title.split(' - ')
+            except Exception as e:
+                print(traceback.format_exc())
+                done += 1
                 continue
-            meta.source = title + (', p. ' + str(meta.page) if meta.page else '')
-            compiled[str(j)] = meta
-            print('-- Converted: Table {} out of a possible {}'.format(j, len(tables)))   
-        xlsx(compiled, outDir=outDir, companyName=companyName, workbookName=title) 
-        print('Completed: {}%.'.format(int((i + 1) / len(queue) * 100)))
-    except Exception as e:
-        print(traceback.format_exc())
-    if i:
-        break
\ No newline at end of file
+            pending[f] = { 'parts': 1, 'tables': 0, 'compiled': {}, 'failed': False, 'companyName': companyName, 'code': filing, 'title': title }
+            if splitSize and workers > 1 and os.path.getsize(f) > splitSize:
+                futures[pool.submit(readTables, f, engine)] = (f, 'read')
+            else:
+                futures[pool.submit(extractTables, f, engine)] = (f, 'extract')
+        print('Extracting tables from {} files with {} workers ({})...'.format(len(queue), workers, engine))
+
+        # Workbooks are written here in the parent as soon as every part of a file is back. A large file comes back
+        # from readTables first and then goes out again, a share of its tables to every worker
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                f, step = futures.pop(future)
+                p = pending[f]
+                p['parts'] -= 1
+                try:
+                    if step == 'read':
+                        p['tables'], items = future.result()
+                        for part in range(workers):
+                            futures[pool.submit(convertTables, f, items[part::workers])] = (f, 'convert')
+                        p['parts'] += workers
+                    elif step == 'convert':
+                        p['compiled'].update(future.result())
+                    else:
+                        p['tables'], p['compiled'] = future.result()
+                except Exception as e:
+                    p['failed'] = True
+                    print('\nFailed: {}'.format(f))
+                    print(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+                if p['parts']:
+                    continue
+                del pending[f]
+                done += 1
+                if not p['failed']:
+                    try:
+                        saveTables(f, p['companyName'], p['code'], p['title'], p['tables'], p['compiled'])
+                    except Exception as e:
+                        print(traceback.format_exc())
+                print('Completed: {}%.'.format(int(done / len(queue) * 100)))
+
+
+def saveTables(f, companyName, code, title, n, compiled):
+    # Writes one file's converted tables, in table order, to its workbook under outdir and to the Parquet dataset
+    outDir = '/'.join(f.split('/')[:-1]).replace(fromdir, outdir) + '/'
+    os.makedirs(outDir, exist_ok=True)
+    compiled = { k: compiled[k] for k in sorted(compiled, key=int) }
+    xlsx(compiled, outDir=outDir, companyName=companyName, workbookName=title, fast=fastWrite)
+    if parquetdir:
+        columnar.write(columnar.tables(compiled, companyName, code, title), parquetdir, name=title)
+    print('-- Converted: {} tables out of a possible {} from {}'.format(len(compiled), n, f))
+
+
+def checkParity(queue):
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = { pool.submit(parity, f): f for f in queue }
+        for future in as_completed(futures):
+            diffs = future.result()
+            if diffs:
+                failed += 1
+                print('\nMismatch: {}'.format(futures[future]))
+                for d in diffs:
+                    print('-- ' + d)
+    print('\nParity: {} of {} files match between bs4 and lxml.'.format(len(queue) - failed, len(queue)))
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)
@@ -0,0 +1,354 @@
+import os
+import json
+import asyncio
+import hashlib
+import contextlib
+import random
+import time
+import email.utils
+import aiohttp
+import yarl
+
+
+# Shared non-blocking HTTP client for everything that talks to the SEC.
+# One keep-alive connection pool is opened lazily inside the running event loop and reused by every Scrape instance.
+# The semaphore caps how many requests are in flight at once, so gathered fetches overlap without flooding EDGAR.
+# The rate limiter caps how many start per second, and throttled or failing requests are retried with jittered backoff.
+# Successful responses are kept in an on-disk cache so re-runs only go to the network for filings they have not seen.
+
+class RateLimiter:
+
+    # Token bucket shared by every outbound request.
+    # Tokens are reserved before any await, so no lock is needed inside a single event loop.
+    # The rate halves whenever EDGAR throttles us and creeps back up towards the configured rate after each success.
+    def __init__(self, rate=10, burst=None, minRate=0.5, recovery=0.1):
+        self.maxRate = rate
+        self.rate = rate
+        self.burst = burst or rate
+        self.minRate = minRate
+        self.recovery = recovery
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+
+    async def acquire(self):
+        now = time.monotonic()
+        if now < self.pausedUntil:
+            await asyncio.sleep(self.pausedUntil - now)
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def throttled(self, pause=0):
+        self.rate = max(self.minRate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        if pause:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + pause)
+
+    def succeeded(self):
+        if self.rate < self.maxRate:
+            self.rate = min(self.maxRate, self.rate + self.recovery)
+
+
+class Cache:
+
+    # Content-addressed store keyed by the sha256 of the full request URL.
+    # Each entry is a body file plus a small JSON file holding the headers needed to decode and revalidate it.
+    def __init__(self, folder='./cache/'):
+        self.folder = folder
+
+    def path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, key[:2], key)
+
+    def load(self, url):
+        path = self.path(url)
+        try:
+            with open(path + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return meta, body
+
+    def has(self, url):
+        return os.path.exists(self.path(url) + '.json')
+
+    def open(self, url):
+        # Same as load, but hands back the open body file so large documents can be read in chunks
+        path = self.path(url)
+        try:
+            with open(path + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            return meta, open(path, 'rb')
+        except (OSError, ValueError):
+            return None
+
+    def store(self, url, response):
+        f = self.begin(url)
+        f.write(response.body)
+        self.commit(url, f, response)
+
+    def begin(self, url):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path + '.tmp', 'wb')
+
+    def commit(self, url, f, response):
+        # Body first and metadata last, each renamed into place, so a crash never leaves a half-written entry
+        path = self.path(url)
+        f.close()
+        os.replace(path + '.tmp', path)
+        self.touch(url, {
+            'url': response.url,
+            'status': response.status,
+            'headers': { k: response.headers[k] for k in ['Content-Type', 'ETag', 'Last-Modified'] if k in response.headers }
+        })
+
+    def abort(self, url, f):
+        f.close()
+        try:
+            os.remove(self.path(url) + '.tmp')
+        except OSError:
+            pass
+
+    def touch(self, url, meta):
+        path = self.path(url)
+        meta['fetched'] = time.time()
+        with open(path + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(path + '.json.tmp', path + '.json')
+
+
+class Response:
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def encoding(self):
+        # Same rules as requests: an explicit charset wins, text/* falls back to ISO-8859-1, anything else to utf-8
+        ctype = self.headers.get('Content-Type', '').lower()
+        for part in ctype.split(';')[1:]:
+            k, _, v = part.strip().partition('=')
+            if k == 'charset' and v:
+                return v.strip('"\'')
+        if 'text' in ctype:
+            return 'ISO-8859-1'
+        return 'utf-8'
+
+    @property
+    def text(self):
+        try:
+            return self.body.decode(self.encoding, errors='replace')
+        except LookupError:
+            return self.body.decode('utf-8', errors='replace')
+
+
+class Stream(Response):
+
+    # A response whose body is read chunk by chunk with `async for chunk in stream`, from the network or the cache
+    def __init__(self, url, status, headers, chunks):
+        super().__init__(url, status, headers, None)
+        self.chunks = chunks
+
+    def __aiter__(self):
+        return self.chunks.__aiter__()
+
+
+class Client:
+
+    # EDGAR answers 403 rather than 429 once the request rate threshold is exceeded
+    throttleStatuses = [403, 429]
+    retryStatuses = [500, 502, 503, 504]
+
+    def __init__(self, concurrency=8, headers={}, timeout=60, rate=10, retries=5, backoff=1, maxBackoff=60, cache=None):
+        self.concurrency = concurrency
+        self.cache = cache
+        self.headers = headers
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate=rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.session = None
+        self.semaphore = None
+        self.stats = {
+            'requests': 0,
+            'throttled': 0,
+            'retried': 0,
+            'failed': 0,
+            'hits': 0,
+            'revalidated': 0,
+            'bytes': 0
+        }
+
+    async def open(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+            )
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.semaphore = None
+
+    def cached(self, url):
+        # Whether fetch(url) would be answered from the cache, ttl aside
+        return self.cache is not None and self.cache.has(str(yarl.URL(url)))
+
+    async def fetch(self, url, params=None, ttl=None):
+        # ttl=None treats a cached copy as permanent, which suits filed documents and their indexes.
+        # Otherwise a copy older than ttl seconds is revalidated with its ETag/Last-Modified before it is reused.
+        target = yarl.URL(url)
+        if params:
+            target = target.with_query(params)
+        key = str(target)
+        cached = self.cache.load(key) if self.cache else None
+        headers = {}
+        if cached:
+            meta, body = cached
+            if ttl is None or time.time() - meta['fetched'] < ttl:
+                self.stats['hits'] += 1
+                return Response(meta['url'], meta['status'], meta['headers'], body)
+            if 'ETag' in meta['headers']:
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if 'Last-Modified' in meta['headers']:
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        r = await self.request(target, headers)
+        if cached and r.status == 304:
+            self.stats['revalidated'] += 1
+            self.cache.touch(key, meta)
+            return Response(meta['url'], meta['status'], meta['headers'], body)
+        if self.cache and r.status == 200:
+            self.cache.store(key, r)
+        return r
+
+    async def request(self, url, headers={}):
+        attempt = 0
+        while True:
+            try:
+                async with self.connect(url, headers) as r:
+                    body = await r.read()
+                    self.stats['bytes'] += len(body)
+                    return Response(str(r.url), r.status, r.headers, body)
+            except aiohttp.ClientPayloadError:
+                # The connection dropped part way through the body; connect only retries up to the headers
+                if attempt >= self.retries:
+                    self.stats['failed'] += 1
+                    raise
+            attempt += 1
+            self.stats['retried'] += 1
+            await asyncio.sleep(self.delay(attempt))
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url, chunkSize=64 * 1024):
+        # Like fetch, for documents too large to buffer. A copy from the network is written to the cache
+        # as it is read, and only kept once the whole body has arrived.
+        key = str(yarl.URL(url))
+        cached = self.cache.open(key) if self.cache else None
+        if cached:
+            meta, f = cached
+            self.stats['hits'] += 1
+
+            async def read():
+                while True:
+                    chunk = f.read(chunkSize)
+                    if not chunk:
+                        return
+                    yield chunk
+
+            with f:
+                yield Stream(meta['url'], meta['status'], meta['headers'], read())
+            return
+        async with self.connect(yarl.URL(url)) as r:
+            f = self.cache.begin(key) if self.cache and r.status == 200 else None
+            complete = False
+
+            async def read():
+                nonlocal complete
+                async for chunk in r.content.iter_chunked(chunkSize):
+                    self.stats['bytes'] += len(chunk)
+                    if f:
+                        f.write(chunk)
+                    yield chunk
+                complete = True
+
+            response = Stream(str(r.url), r.status, r.headers, read())
+            try:
+                yield response
+            finally:
+                if f and complete:
+                    self.cache.commit(key, f, response)
+                elif f:
+                    self.cache.abort(key, f)
+
+    @contextlib.asynccontextmanager
+    async def connect(self, url, headers={}):
+        # Yields an open response once its status is final. Throttled (403/429) and 5xx answers and connection
+        # errors are retried with backoff; the semaphore stays held until the caller has read the body.
+        session = await self.open()
+        attempt = 0
+        while True:
+            wait = 0
+            async with self.semaphore:
+                await self.limiter.acquire()
+                self.stats['requests'] += 1
+                try:
+                    r = await session.get(url, headers=headers)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt >= self.retries:
+                        self.stats['failed'] += 1
+                        raise
+                    r = None
+                if r is not None:
+                    try:
+                        retry = r.status in self.throttleStatuses or r.status in self.retryStatuses
+                        if retry and attempt < self.retries:
+                            wait = self.retryAfter(r.headers.get('Retry-After'))
+                            if r.status in self.throttleStatuses:
+                                self.stats['throttled'] += 1
+                                self.limiter.throttled(wait)
+                        else:
+                            if r.status >= 400:
+                                self.stats['failed'] += 1
+                                r.raise_for_status()
+                            self.limiter.succeeded()
+                            yield r
+                            return
+                    finally:
+                        r.release()
+            attempt += 1
+            self.stats['retried'] += 1
+            await asyncio.sleep(max(wait, self.delay(attempt)))
+
+    def delay(self, attempt):
+        # Full jitter keeps a burst of throttled requests from retrying in lockstep
+        return random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** (attempt - 1)))
+
+    def retryAfter(self, value):
+        if not value:
+            return 0
+        try:
+            return min(self.maxBackoff, max(0, float(value)))
+        except ValueError:
+            pass
+        try:
+            d = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return 0
+        return min(self.maxBackoff, max(0, d.timestamp() - time.time()))
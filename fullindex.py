@@ -0,0 +1,83 @@
+import gzip
+import numpy as np
+import pandas as pd
+
+
+# EDGAR's quarterly full indexes (https://www.sec.gov/Archives/edgar/full-index/<year>/QTR<n>/) as one table.
+# Each index lists every filing of its quarter, so a few of them stand in for one browse-edgar query per company
+# per form code. form.idx is fixed width and master.idx is pipe delimited; gzipped copies (.gz) read the same.
+# Entries are handed to Scrape.parse shaped like a converted browse-edgar Atom page.
+
+columns = ['cik', 'company', 'type', 'date', 'accession']
+
+
+def header(path):
+    # The column titles line and how many lines precede the first entry, which comes after a line of dashes
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='latin-1') as f:
+        lines = []
+        for n, line in enumerate(f):
+            if line.startswith('---'):
+                return lines[-1] if lines else '', n + 1
+            if line.strip():
+                lines.append(line.rstrip('\n'))
+    raise ValueError('No index entries found in {}'.format(path))
+
+
+def read(path):
+    title, skip = header(path)
+    if '|' in title:
+        df = pd.read_csv(
+            path, sep='|', skiprows=skip, header=None, names=['cik', 'company', 'type', 'date', 'file'],
+            dtype={ 'cik': np.int64, 'company': str, 'type': str, 'date': str, 'file': str }, encoding='latin-1'
+        )
+    else:
+        starts = [title.index(t) for t in ['Form Type', 'Company Name', 'CIK', 'Date Filed', 'File Name']]
+        df = pd.read_fwf(
+            path, colspecs=list(zip(starts, starts[1:] + [None])), skiprows=skip, header=None,
+            names=['type', 'company', 'cik', 'date', 'file'], dtype={ 'type': str, 'company': str, 'cik': np.int64, 'date': str, 'file': str },
+            encoding='latin-1'
+        )
+    # edgar/data/320193/0000320193-20-000096.txt
+    df['accession'] = df['file'].str.rsplit('/', n=1).str[-1].str.replace('.txt', '', regex=False)
+    df['date'] = pd.to_datetime(df['date'])
+    df['company'] = df['company'].str.strip().astype('category')
+    df['type'] = df['type'].str.strip().astype('category')
+    return df[columns]
+
+
+def load(paths):
+    if not paths:
+        raise ValueError('No full-index files to load')
+    # A quarter's form.idx and master.idx list the same filings, so each accession is kept once
+    df = pd.concat([read(p) for p in paths], ignore_index=True).drop_duplicates('accession', ignore_index=True)
+    for c in ['company', 'type']:
+        df[c] = df[c].astype('category')
+    return df
+
+
+def select(df, ciks=None, types=None, datestart='', dateend=''):
+    # Vectorized filter; ciks are compared as numbers, so zero-padded CIK strings match
+    mask = np.ones(len(df), dtype=bool)
+    if ciks is not None:
+        mask &= df['cik'].isin([int(c) for c in ciks]).values
+    if types is not None:
+        mask &= df['type'].isin(list(types)).values
+    if datestart:
+        mask &= (df['date'] >= pd.Timestamp(datestart)).values
+    if dateend:
+        mask &= (df['date'] <= pd.Timestamp(dateend)).values
+    return df[mask].drop_duplicates('accession').sort_values(['date', 'accession'], ascending=False)
+
+
+def page(df, base='https://www.sec.gov'):
+    # One filer's rows as the dict Scrape.convert makes of a browse-edgar Atom page, newest first
+    entries = [{
+        'content': { 'filing-date': d.strftime('%Y-%m-%d'), 'accession-number': accession },
+        'category': { '@term': t },
+        'link': { '@href': '{}/Archives/edgar/data/{}/{}/{}-index.htm'.format(base, cik, accession.replace('-', ''), accession) }
+    } for cik, t, d, accession in zip(df['cik'], df['type'], df['date'], df['accession'])]
+    return { 'feed': {
+        'company-info': { 'conformed-name': str(df['company'].iloc[0]) if len(df) else '' },
+        'entry': entries
+    } }
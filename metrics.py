@@ -0,0 +1,111 @@
+import os
+import io
+import json
+import time
+import math
+import bisect
+import pstats
+import cProfile
+import contextlib
+
+
+# Run-wide timings for scrape.py: a latency histogram per stage, the slowest filings per stage, and a JSON report.
+# Stages are timed on the wall clock, so an async stage includes the time it spent waiting on the network or the
+# request budget; that is what decides how long a run takes.
+
+class Metrics:
+
+    # Histogram bucket upper bounds in seconds, doubling from 1 ms. Anything slower lands in the last bucket
+    buckets = [0.001 * 2 ** i for i in range(18)]
+    slowest = 10
+
+    def __init__(self):
+        self.started = time.time()
+        self.clock = time.monotonic()
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, key=''):
+        # with metrics.stage('links', url): ... records how long the block took, also when it raises
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start, key)
+
+    def record(self, name, seconds, key=''):
+        s = self.stages.get(name)
+        if s is None:
+            s = self.stages[name] = { 'times': [], 'counts': [0] * (len(self.buckets) + 1), 'slowest': [] }
+        s['times'].append(seconds)
+        s['counts'][bisect.bisect_left(self.buckets, seconds)] += 1
+        if key:
+            s['slowest'].append((seconds, key))
+            if len(s['slowest']) > self.slowest * 2:
+                s['slowest'] = sorted(s['slowest'], reverse=True)[:self.slowest]
+
+    def summary(self, name):
+        s = self.stages[name]
+        times = sorted(s['times'])
+        n = len(times)
+
+        def percentile(p):
+            return times[min(n - 1, max(0, math.ceil(p * n) - 1))]
+
+        return {
+            'count': n,
+            'total': sum(times),
+            'mean': sum(times) / n,
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': times[-1],
+            'histogram': {
+                ('<= {:g} s'.format(b) if i < len(self.buckets) else '> {:g} s'.format(self.buckets[-1])): c
+                for i, (b, c) in enumerate(zip(self.buckets + [None], s['counts'])) if c
+            },
+            'slowest': [{ 'seconds': t, 'key': k } for t, k in sorted(s['slowest'], reverse=True)[:self.slowest]]
+        }
+
+    def report(self, stats={}):
+        # stats are fetch.Client's counters: requests, hits, bytes and so on
+        elapsed = time.monotonic() - self.clock
+        lookups = stats.get('requests', 0) + stats.get('hits', 0)
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': elapsed,
+            'requests': stats,
+            'requestsPerSecond': stats.get('requests', 0) / elapsed if elapsed else 0,
+            'bytesPerSecond': stats.get('bytes', 0) / elapsed if elapsed else 0,
+            'cacheHitRatio': stats.get('hits', 0) / lookups if lookups else 0,
+            'stages': { name: self.summary(name) for name in self.stages }
+        }
+
+    def write(self, path, stats={}):
+        report = self.report(stats)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        print('\nRun report: {} ({:.1f} s, {:.1f} requests/s, {:.0%} cache hits)'.format(path, report['seconds'], report['requestsPerSecond'], report['cacheHitRatio']))
+        for name, s in report['stages'].items():
+            print('-- {:<10} {:>6} x  mean {:>8.1f} ms  p90 {:>8.1f} ms  max {:>8.1f} ms'.format(name, s['count'], s['mean'] * 1000, s['p90'] * 1000, s['max'] * 1000))
+        return report
+
+
+def profile(fn, path='', limit=25):
+    # Runs fn() under cProfile, prints the hottest functions by own time and keeps the raw stats in path for snakeviz etc.
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn)
+    finally:
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('tottime').print_stats(limit)
+        print(out.getvalue())
+
+
+metrics = Metrics()
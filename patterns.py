@@ -0,0 +1,36 @@
+import re
+
+
+# Precompiled matchers for title, reference and quarter detection, shared by scrape.py and document.py.
+# None of them can backtrack across markup. Tag bodies are matched with [^<>]* instead of .*, every repeated
+# group is followed by something it cannot match, and no tag body is scanned by two [^<>]* in a row, which would
+# pair up every two positions inside one long unclosed tag. A single-line 5MB document is one linear scan.
+
+# "For the fiscal year ended December 31, 2019" / "For the quarterly period ended: June 30, 2020"
+fiscalTitle = re.compile(r"For\s+the\s+(fiscal\s+year|quarterly\s+period)\s+ended:?\s+(\w+\s+\d{1,2},\s+\d{1,4})")
+
+# A four digit year, allowing the single spaces some filings put between digits
+year = re.compile(r"[0-9]\s?[0-9]\s?[0-9]\s?[0-9]")
+
+# Regex fallbacks for documents lxml cannot parse.
+# <p ...><b>Title</b></p>, optionally with one inline tag around the text inside the <b>
+boldParagraph = re.compile(r"<p\b[^<>]*><b>(?:<[^<>]*>)?([\w\s]+)(?:</[^<>]*>)?</b></p>")
+# <span style="...font-weight:bold...">Text</span>, optionally with one inline tag around the text.
+# The text may hold the comma and colon of "ended: June 30, 2020", which fiscalTitle needs to see.
+# style= and font-weight are looked for by separate lookaheads, each one pass over the tag.
+boldSpan = re.compile(r"<span\b(?=[^<>]*\bstyle=)(?=[^<>]*font-weight:\s?bold)[^<>]*>(?:<[^<>]*>)?((?:[\w\s,:-]|&nbsp;)+)(?:</[^<>]*>)?</span>")
+
+# One pass over a lowercased title for every quarter keyword; the group number is the quarter.
+# getQuarter takes the lowest group found, which keeps the old first-quarter-first precedence.
+quarter = re.compile(r"(first quarter|march|april)|(second quarter|june|july)|(third quarter|september|october)|(fourth quarter|december|january)")
+
+# EDGAR's index.json lists an accession folder's file names without their document types, so the one document
+# locate() wants is recognised by name: EX-99.1 for a 6-K (ex99-1.htm, d12345dex991.htm), the main document
+# otherwise (d12345d10k.htm, form20-f.htm, a10-kx20191231.htm). An 'x' may separate the form from a date.
+exhibit = re.compile(r"ex(?:hibit)?[-_]?\d", re.I)
+documentNames = {
+    '6-K': re.compile(r"ex(?:hibit)?[-_]?99[-_.]?0?1(?![0-9])", re.I),
+    '20-F': re.compile(r"20[-_]?f(?![a-wyz0-9])", re.I),
+    '10-K': re.compile(r"10[-_]?k(?![a-wyz0-9])", re.I),
+    '10-Q': re.compile(r"10[-_]?q(?![a-wyz0-9])", re.I)
+}
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import asyncio
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import scrape
+import extract
+import convert
+
+# scrape.py, extract.py and convert.py in one run. Every filing Scrape.writeFile puts on disk goes straight onto a
+# bounded queue per stage, so its tables are extracted and its PDF rendered while later filings are still downloading.
+# A full queue makes writeFile wait, which holds back that company's further downloads until the stage catches up.
+# Usage: python pipeline.py [--no-extract] [--no-pdf], plus any of scrape.py's flags
+
+queueSize = 16                  # Filings waiting per stage before scraping is held back
+
+
+class Stage:
+
+    # A bounded queue of (path, filing) and the workers draining it. work is an async callable per filing.
+    def __init__(self, name, work, workers=1, size=queueSize):
+        self.name = name
+        self.work = work
+        self.queue = asyncio.Queue(size)
+        self.done = 0
+        self.failed = 0
+        self.tasks = [asyncio.ensure_future(self.worker()) for _ in range(workers)]
+
+    async def put(self, path, filing):
+        await self.queue.put((path, filing, time.monotonic()))
+
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            path, filing, queued = item
+            try:
+                await self.work(path, filing)
+                self.done += 1
+                print('-- {}: {} ({:.1f} s after it landed)'.format(self.name.capitalize(), path, time.monotonic() - queued))
+            except Exception:
+                self.failed += 1
+                print('-- {} failed: {}'.format(self.name.capitalize(), path))
+                print(traceback.format_exc())
+
+    async def close(self):
+        # Lets the workers finish what is already queued, then stops them
+        for _ in self.tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.tasks)
+
+
+def extractStage(processes):
+    async def work(path, filing):
+        # Same split as extract.py: a large file is parsed once and its tables shared out across every worker process
+        loop = asyncio.get_running_loop()
+        if extract.splitSize and extract.workers > 1 and os.path.getsize(path) > extract.splitSize:
+            n, items = await loop.run_in_executor(processes, extract.readTables, path, extract.engine)
+            results = await asyncio.gather(*[
+                loop.run_in_executor(processes, extract.convertTables, path, items[part::extract.workers]) for part in range(extract.workers)
+            ])
+            compiled = {}
+            for c in results:
+                compiled.update(c)
+        else:
+            n, compiled = await loop.run_in_executor(processes, extract.extractTables, path, extract.engine)
+        title = os.path.basename(path).replace('.html', '')
+        companyName = title.split(' - ')[0]
+        await loop.run_in_executor(None, extract.saveTables, path, companyName, filing['type'], title, n, compiled)
+
+    return Stage('extract', work, extract.workers)
+
+
+def convertStage(threads):
+    converter = convert.pdfkitConverter(convert.wkhtmltopdf, convert.timeout)
+
+    async def work(path, filing):
+        await asyncio.get_running_loop().run_in_executor(threads, convert.convertFile, path, converter)
+
+    return Stage('pdf', work, convert.workers)
+
+
+async def main():
+    # Both stages read from where scrape.py saves filings
+    extract.fromdir = scrape.outHTMLFolder
+    convert.fromdir = scrape.outHTMLFolder
+    with ProcessPoolExecutor(max_workers=extract.workers) as processes, ThreadPoolExecutor(max_workers=convert.workers) as threads:
+        stages = []
+        if '--no-extract' not in sys.argv[1:]:
+            stages.append(extractStage(processes))
+        if '--no-pdf' not in sys.argv[1:]:
+            stages.append(convertStage(threads))
+
+        async def sink(path, filing):
+            for stage in stages:
+                await stage.put(path, filing)
+
+        try:
+            await scrape.main(sink)
+        finally:
+            for stage in stages:
+                await stage.close()
+        for stage in stages:
+            print('{}: {} done, {} failed'.format(stage.name.capitalize(), stage.done, stage.failed))
+        return sum(stage.failed for stage in stages)
+
+
+if __name__ == '__main__':
+    sys.exit(1 if asyncio.run(main()) else 0)
@@ -0,0 +1,80 @@
+import os
+import json
+import glob
+import asyncio
+import threading
+import yarl
+from aiohttp import web
+
+
+# A local stand-in for EDGAR that answers from recorded responses, for benchmarks that must not touch sec.gov.
+# Fixtures are a fetch.Cache folder: run scrape.py once with cacheFolder = './fixtures/' and every feed page, filing
+# index and document it fetched is recorded. Absolute https://www.sec.gov links in the replayed bodies are rewritten
+# to the server's own address, so feeds and indexes lead the scraper back here.
+
+class Replay:
+
+    def __init__(self, folder='./fixtures/', latency=0, origin='https://www.sec.gov'):
+        self.folder = folder
+        self.latency = latency          # Seconds added before every answer, to stand in for the round trip
+        self.origin = origin
+        self.responses = {}
+        self.base = ''
+        self.served = 0
+        self.missed = 0
+        self.load()
+
+    def load(self):
+        for meta in glob.glob(os.path.join(self.folder, '*', '*.json')):
+            path = meta[:-len('.json')]
+            try:
+                with open(meta, encoding='utf-8') as f:
+                    m = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if os.path.exists(path):
+                self.responses[str(yarl.URL(m['url']).relative())] = (path, m['headers'].get('Content-Type', 'text/html'))
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        found = self.responses.get(str(request.rel_url))
+        if found is None:
+            self.missed += 1
+            return web.Response(status=404)
+        path, contentType = found
+        with open(path, 'rb') as f:
+            body = f.read()
+        if 'html' in contentType or 'xml' in contentType:
+            body = body.replace(self.origin.encode('ascii'), self.base.encode('ascii'))
+        self.served += 1
+        return web.Response(body=body, headers={ 'Content-Type': contentType })
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_route('GET', '/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base = 'http://{}:{}'.format(host, port)
+        return self.base
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def serve(self):
+        # Runs the server on its own event loop in a background thread, so the benchmarked code keeps the main one.
+        # Returns the base URL to use in place of https://www.sec.gov.
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self.base
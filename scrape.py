@@ -13,7 +13,7 @@
 
 # Comment out the following lines if not running this program in Jupyter and use pip install the normal way.
 '''
-get_ipython().system(' pip install requests')
+get_ipython().system(' pip install aiohttp')
 get_ipython().system(' pip install xmltodict')
 get_ipython().system(' pip install datetime')
 get_ipython().system(' pip install asyncio')
@@ -27,16 +27,19 @@ get_ipython().system(' pip install pandas')
 # In[501]:
 
 
-import requests
 import xmltodict
+import aiohttp
 import asyncio
 import datetime
 import time
-from pyquery import PyQuery as pq
+import codecs
+import lxml.html
+import lxml.etree
+from pyquery.text import extract_text
 from pathlib import Path
+from glob import glob
 import sys
 import os
-import re
 
 import openpyxl
 import xlsxwriter
@@ -46,6 +49,14 @@ import pandas.io.formats.excel
 import csv
 import json
 from write import xlsx
+from fetch import Client, Cache
+from document import Document, StreamExtract, hasBold
+from state import State, Journal
+from catalog import Catalog
+import patterns
+import columnar
+import fullindex
+from metrics import metrics, profile
 
 
 # ## 0: Set configuration variables
@@ -101,14 +112,35 @@ datestart = '2015-01-01'
 dateend = ''
 base = 'https://www.sec.gov'
 
+maxConcurrency = 8               # Cap on requests in flight at once, shared by all companies
+requestsPerSecond = 10           # SEC fair access limit. The limiter halves this on throttling and recovers gradually
+maxRetries = 5                   # Retries for throttled (403/429) and 5xx responses, with jittered exponential backoff
+cacheFolder = './cache/'         # On-disk HTTP cache. Filed documents and indexes are kept forever. Set to '' to disable
+feedTTL = 60 * 60                # Seconds before a cached browse-edgar feed is revalidated with the SEC
+feedPageSize = 100               # Entries per browse-edgar page. Further pages are followed until the start date is passed
+userAgent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/84.0.4147.105 Safari/537.36'
+
 downloadHTMLs = True
 outFolder = './data/'
 outHTMLFolder = './htmls/'
+stateFolder = './state/'         # Accessions and rows already processed, per CIK and form code, for --incremental runs
+parquetFolder = './parquet/filings/'   # Typed copy of every sheet, partitioned by company and form code (see columnar.py). Set to '' to disable
+catalogPath = './catalog.sqlite'     # Every kept filing across companies and runs (see catalog.py). Set to '' to disable
+journalPath = './state/journal.jsonl'   # Checkpoint of finished filings for --resume, removed once the workbook is written. '' disables
+metricsPath = './data/run.json'      # Per-stage timings, throughput and cache hit ratio of the last run (see metrics.py)
+profilePath = './data/run.prof'      # cProfile stats written by --profile runs
 
 # Set configuration for output file (xlsx and downloads)
 pageBreakSize = 3
+streamThreshold = 5 * 1024 * 1024   # Documents larger than this (bytes) are scanned as a stream instead of parsed into a DOM
 maxrows = None
 isTest = False                   # Test runs fetch less data
+incremental = False              # Only process filings newer than the last run and merge them into the stored rows
+report = False                   # Build the workbook from the catalog alone, with no network requests or HTML parsing
+resume = False                   # Pick up a run that died part way, replaying the filings it had finished from the journal
+fullIndex = False                # Find filings in local EDGAR full-index files instead of one browse-edgar feed per company and code
+linkResolver = 'json'            # 'json' finds the document in the accession folder's index.json by file name, 'html' always reads the -index.htm page
+fullIndexFiles = './full-index/**/*.idx*'  # form.idx/master.idx copies, optionally gzipped, from https://www.sec.gov/Archives/edgar/full-index/
 
 # Download selection configuration
 def locate(filing):
@@ -127,16 +159,37 @@ def locate(filing):
         f = f.replace('ix?doc=/', '')
     return f
 
+# Rows of the document tables on a filing's -index.htm page
+indexRows = lxml.etree.XPath("//table[contains(concat(' ', normalize-space(@class), ' '), ' tableFile ')]//tr")
+
 # Don't set this
-if len(sys.argv) > 1:
-    if sys.argv[1] == '--test':
-        isTest = True
+if '--test' in sys.argv[1:]:
+    isTest = True
+if '--incremental' in sys.argv[1:]:
+    incremental = True
+if '--report' in sys.argv[1:]:
+    report = True
+if '--full-index' in sys.argv[1:]:
+    fullIndex = True
+if '--resume' in sys.argv[1:]:
+    resume = True
 if isTest:
     maxrows = 2
 
+# One connection pool for every Scrape instance
+client = Client(
+    concurrency=maxConcurrency,
+    headers={'User-Agent': userAgent},
+    rate=requestsPerSecond,
+    retries=maxRetries,
+    cache=Cache(cacheFolder) if cacheFolder else None
+)
+catalog = Catalog(catalogPath) if catalogPath else None
+journal = None                  # Opened by main()
+
 class Scrape:
 
-    def __init__(self, companyName='', cik='', codes=[], datestart = '', dateend = ''):
+    def __init__(self, companyName='', cik='', codes=[], datestart = '', dateend = '', sink=None):
         
         print('\nStarting download process for %s...' % (companyName))
         self.companyName = companyName
@@ -147,6 +200,9 @@ class Scrape:
         self.workbookTitle = ''
         self.url = ''
         self.debug_url = ''
+        self.feeds = []
+        self.sink = sink                # Awaited with (path, filing) for every filing written to disk, see pipeline.py
+        self.index = None               # This filer's full-index rows in --full-index runs, set by main()
 
         self.folder = outFolder + companyName + '/'
         self.fileFolder = outHTMLFolder + companyName + '/'
@@ -158,23 +214,15 @@ class Scrape:
 
     async def run(self):
         arr = []
-        for k in self.codes:
-            xml = self.get(k)
-            obj = self.convert(xml)
-            a = await self.parse(obj, companyName=self.companyName)
-            for filing in a:
-                for k in filing.keys():
-                    if k.startswith('_'):
-                        try:
-                            del a[k]
-                        except:
-                            pass
+        # Form codes are fetched side by side; the client's concurrency cap is the shared request budget
+        results = await asyncio.gather(*[self.runCode(k) for k in self.codes])
+        for a in results:
             arr.extend(a)
             
         if isTest:
             # Creates an intermediate XML output. Mainly for debugging purposes. Comment out if undesirable.
             f = open(self.folder + self.companyName + '.xml', 'w')
-            f.write(xml)
+            f.write('\n'.join(self.feeds))
             f.close()
 
             # Creates an intermediate JSON output. Mainly for debugging purposes. Comment out if undesirable.
@@ -197,7 +245,30 @@ class Scrape:
             r.writerows(arr)
             f.close()
 
-        # Creates main .xlsx output using pandas.
+        return self.sheets(arr)
+
+    def report(self):
+        # Same sheets as run, from the filings the catalog holds for this company
+        arr = []
+        for f in catalog.filings(self.cik, self.codes, self.datestart or datestart, self.dateend or dateend):
+            self.workbookTitle = self.workbookTitle or f['company']
+            reference = f['reference'] or ''
+            if not f['quarter'] and reference.isdigit():
+                reference = int(reference)
+            arr.append({
+                'date': self.getDate(datetime.datetime.fromisoformat(f['date'])),
+                'type': f['type'],
+                'index': f['index'],
+                'source': f['source'],
+                'title': f['title'],
+                'pages': f['pages'],
+                'quarter': f['quarter'],
+                'reference': reference
+            })
+        return self.sheets(arr, store=False)
+
+    def sheets(self, arr, store=True):
+        # Creates main .xlsx output using pandas. store also writes each sheet to the Parquet dataset
         obj = {}
         for code in self.codes:
             kept = list(filter(lambda x: x['type'] == code, arr))
@@ -206,27 +277,88 @@ class Scrape:
             columns = self.getColumns(kept, code)
             df = pd.DataFrame(kept, columns=columns)
             obj[self.companyName + ' ' + code] = df
+            if store and parquetFolder:
+                columnar.write(columnar.filings(kept, self.companyName, code, self.cik), parquetFolder)
         return obj
 
+    async def runCode(self, code):
+        state = State(self.cik, code, stateFolder) if incremental else None
+        pages = self.indexPages(code) if self.index is not None else self.feed(code)
+        a = await self.parse(pages, companyName=self.companyName, state=state)
+        if state is not None:
+            # Filings that failed to download stay in this workbook and pending in the state, so the next run retries them
+            a = sorted([f for f in a if f['_accession'] not in state] + state.rows, key=lambda f: f['date'], reverse=True)
+            state.save()
+        if catalog is not None:
+            # Rows carried over from the state have no _accession; they were catalogued by the run that found them
+            catalog.upsert(self.cik, self.workbookTitle or self.companyName, a)
+        for filing in a:
+            for k in [k for k in filing.keys() if k.startswith('_')]:
+                del filing[k]
+        return a
+
     # ### 1: Get the data from the SEC website
 
-    def get(self, t=''):
+    async def get(self, t='', start=0, url=''):
         params = {
             'action': 'getcompany',
-            'start': self.datestart or datestart or 0,
+            'start': start,
             'type': t,
             'dateb': self.dateend or dateend,
             'owner': '',
             'search_text': '',
             'CIK': self.cik,
-            'count': 100,
+            'count': feedPageSize,
             'output': 'atom'
         }
-        r = requests.get(base + '/cgi-bin/browse-edgar', params)
+        with metrics.stage('get', url or '{} {}'.format(self.cik, t)):
+            if url:
+                r = await client.fetch(url, ttl=feedTTL)
+            else:
+                r = await client.fetch(base + '/cgi-bin/browse-edgar', params, ttl=feedTTL)
         print('-- Indexing: ', r.url)
         self.url = r.url
+        self.feeds.append(r.text)
         return r.text
 
+    async def feed(self, t=''):
+        # Yields one converted page of the Atom feed at a time, following its rel="next" link.
+        # Paging stops once a page reaches back past the start date, since the feed is newest first.
+        start = 0
+        url = ''
+        while True:
+            data = self.convert(await self.get(t, start=start, url=url))
+            yield data
+            entries = self.entries(data)
+            if len(entries) < feedPageSize:
+                break
+            if entries[-1]['content']['filing-date'] < (self.datestart or datestart or ''):
+                break
+            url = self.nextPage(data)
+            start += feedPageSize
+
+    async def indexPages(self, t=''):
+        # The full-index rows for one form code, as a single page shaped like a converted feed page
+        yield fullindex.page(self.index[self.index['type'] == t], base)
+
+    def entries(self, data):
+        entries = data['feed'].get('entry', [])
+        if isinstance(entries, dict):
+            return [entries]
+        return entries
+
+    def nextPage(self, data):
+        links = data['feed'].get('link', [])
+        if isinstance(links, dict):
+            links = [links]
+        for l in links:
+            if l.get('@rel') == 'next' and l.get('@href'):
+                href = l['@href']
+                if href.startswith('/'):
+                    href = base + href
+                return href
+        return ''
+
 
     # ### 2. Convert the resulting XML into a python dict
 
@@ -236,65 +368,133 @@ class Scrape:
 
     # ### 3. Handle the dict to remove unwanted terms and select only the data needed
 
-    async def parse(self, data, companyName=''):
+    async def parse(self, pages, companyName='', state=None):
         table = []
         rows = []
-        filingPromises = []
-        downloadPromises = []
-        
-        if not self.workbookTitle:
-            self.workbookTitle = data['feed']['company-info']['conformed-name']
+        tasks = []
+        processed = []
+        queued = set()
+        i = 0
         
-        if 'entry' in data['feed']:
-            for i, e in enumerate(data['feed']['entry']):
-                if not self.filterScraped(e):
-                    continue
-                if maxrows != None and i >= maxrows:
+        # Each filing is handed to its own task as soon as its page arrives, so indexes and documents
+        # for page 1 are already downloading while page 2 of the feed is still being fetched
+        try:
+            async for data in pages:
+                if not self.workbookTitle:
+                    self.workbookTitle = data['feed']['company-info']['conformed-name']
+                stop = False
+                for e in self.entries(data):
+                    accession = self.getAccession(e)
+                    if state is not None and accession in state:
+                        # The feed is newest first, so everything from here on was handled by an earlier run
+                        stop = True
+                        break
+                    if accession in queued:
+                        # Listed twice (overlapping index files or feed pages); both would stream to the same .part file
+                        continue
+                    queued.add(accession)
+                    i += 1
+                    if not self.filterScraped(e):
+                        continue
+                    if maxrows != None and i > maxrows:
+                        stop = True
+                        break
+
+                    # Date handling
+                    d = datetime.datetime.fromisoformat(e['content']['filing-date'])
+                    date = self.getDate(d)
+                    row = {
+                        'date': date,
+                        'type': e['category']['@term'],
+                        'index': e['link']['@href'],
+                        'source': '',
+                        '_datetime': d,
+                        '_accession': accession
+                    }
+                    tasks.append(asyncio.ensure_future(self.runFiling(row)))
+                    rows.append(row)
+                if stop:
                     break
+        finally:
+            await pages.aclose()
 
-                # Date handling
-                d = datetime.datetime.fromisoformat(e['content']['filing-date'])
-                date = self.getDate(d)
-                row = {
-                    'date': date,
-                    'type': e['category']['@term'],
-                    'index': e['link']['@href'],
-                    'source': '',
-                    '_datetime': d
-                }
-                filingPromises.append(self.links(row['index']))
-                rows.append(row)
-        filings = await asyncio.gather(*filingPromises)
-
-        for i in range(0, len(rows)):
-            filing = { **rows[i], 'source': locate({ **rows[i], **filings[i]}) }
-            rows[i] = filing
-            downloadPromises.append(self.downloadFile({ **rows[i], **filings[i]}))
-        downloads = await asyncio.gather(*downloadPromises)
-
-        writingPromises = []
-
-        for i in range(0, len(rows)):
-            filing = rows[i]
-            if downloads[i]:
-                filing['title'] = self.getTitle(downloads[i], filing)
-                filing['pages'] = self.getPages(downloads[i])
-                if not self.isStatement(filing):
+        if state is not None:
+            # Earlier failures are older than where the feed stopped, so they are queued from the state
+            for row in state.retry():
+                if row['_accession'] in queued:
                     continue
-                filing['quarter'] = self.getQuarter(filing)
-                filing['reference'] = self.getReference(filing)
-                if downloadHTMLs:
-                    writingPromises.append(self.writeFile(downloads[i], rows[i]))
+                queued.add(row['_accession'])
+                tasks.append(asyncio.ensure_future(self.runFiling(row)))
+                rows.append(row)
+        results = await asyncio.gather(*tasks)
+
+        failed = []
+        for row, (filing, done) in zip(rows, results):
+            if done:
+                processed.append(row['_accession'])
             else:
-                filing['pages'] = 0
-                if filing['type'] == '6-K':
-                    continue
-            table.append(filing)
-            
-        await asyncio.gather(*writingPromises)
+                failed.append(row)
+            if filing is not None:
+                table.append(filing)
+
+        if state is not None:
+            state.update(processed, [x for x in table if x['_accession'] in processed], failed)
         
         return table
 
+    async def runFiling(self, row):
+        # parseFiling with checkpoints: a filing the journal has as finished is replayed from it, in its place in the
+        # feed, so a resumed run builds the same workbook. Filings that are not done stay out of the journal and are tried again.
+        if journal is not None and row['_accession'] in journal:
+            filing, done = journal.replay(row)
+            if filing is not None and self.sink is not None:
+                # A filing is journaled once it is on a pipeline stage's queue, which the crash may have lost,
+                # so every replayed filing still on disk goes to the sink again
+                name = self.fileName(filing)
+                if os.path.exists(name):
+                    await self.sink(name, filing)
+            return filing, done
+        filing, done = await self.parseFiling(row)
+        if journal is not None and done:
+            journal.record(row['_accession'], filing)
+        return filing, done
+
+    async def parseFiling(self, row):
+        # Returns the finished row, or None when it is left out of the table, and whether the filing is done with.
+        # A failed index or document download is not done, so incremental runs keep it pending and try it again next
+        # time. An index that loaded but lists no document is done.
+        with metrics.stage('links', row['index']):
+            links = await self.links(row['index'], row['type'])
+        filing = { **row, 'source': locate({ **row, **(links or {}) }) }
+        with metrics.stage('download', filing['source']):
+            path = await self.downloadFile({ **filing, **(links or {}) })
+        done = links is not None and (bool(path) or not filing['source'])
+        if path:
+            with metrics.stage('parse', filing['source']):
+                filing['title'], filing['pages'] = self.readMeta(path, filing)
+            if not self.isStatement(filing):
+                self.removeFile(path)
+                return None, done
+            filing['quarter'] = self.getQuarter(filing)
+            filing['reference'] = self.getReference(filing)
+            if downloadHTMLs:
+                # Includes any wait for a pipeline stage to take the file
+                with metrics.stage('write', filing['source']):
+                    await self.writeFile(path, filing)
+            else:
+                self.removeFile(path)
+        else:
+            filing['pages'] = 0
+            if filing['type'] == '6-K':
+                return None, done
+        return filing, done
+
+    def getAccession(self, e):
+        accession = e['content'].get('accession-number', '')
+        if not accession:
+            accession = e['link']['@href'].split('/')[-1].replace('-index.htm', '')
+        return accession
+
     def filterScraped(self, e):
         if e['category']['@term'] not in self.codes:
             return False
@@ -304,27 +504,79 @@ class Scrape:
             return False
         return True
 
-    async def writeFile(self, html, filing):
-        name = '{}{} - {} - {}.html'.format(self.fileFolder, self.companyName, filing['reference'], filing['type'])
-        f = open(name, 'w', encoding='utf-8')
-        f.write(html)
-        f.close()
+    async def writeFile(self, path, filing):
+        # The download already sits in a temporary file next to its final name, so this is an atomic rename
+        name = self.fileName(filing)
+        os.replace(path, name)
+        if self.sink is not None:
+            await self.sink(name, filing)
+
+    def fileName(self, filing):
+        return '{}{} - {} - {}.html'.format(self.fileFolder, self.companyName, filing['reference'], filing['type'])
+
+    def removeFile(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
     # ### 4. Link pulling and cacheing
 
-    async def links(self, url):
-        d = pq(url=url)
-        parent = d('table.tableFile tr')
+    async def links(self, url, t=''):
+        # Document type to URL map of one filing, for locate(). An index page already in the cache is read as is.
+        # Otherwise the accession folder's index.json is tried first, and the index page is the fallback.
+        # None when the index page could not be fetched, so the filing is tried again rather than taken as empty.
+        if linkResolver == 'json' and not client.cached(url):
+            obj = await self.jsonLinks(url, t)
+            if obj:
+                return obj
+        return await self.htmlLinks(url)
+
+    async def jsonLinks(self, url, t=''):
+        # Only answers when exactly one .htm file in the folder is named like the document locate() wants for
+        # this form type; anything ambiguous returns {} and goes to the index page
+        pattern = patterns.documentNames.get(t)
+        if pattern is None:
+            return {}
+        folder = url.rsplit('/', 1)[0]
+        try:
+            r = await client.fetch(folder + '/index.json')
+            items = json.loads(r.text)['directory']['item']
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError):
+            return {}
+        # Sub-folders are listed with the icon type 'folder.gif'
+        names = [i['name'] for i in items if i.get('type') != 'folder.gif' and i['name'].lower().endswith(('.htm', '.html'))]
+        if t == '6-K':
+            matches = [n for n in names if pattern.search(n)]
+        else:
+            matches = [n for n in names if pattern.search(n) and not patterns.exhibit.search(n)]
+        if len(matches) != 1:
+            return {}
+        return { ('EX-99.1' if t == '6-K' else t): folder + '/' + matches[0] }
+
+    async def htmlLinks(self, url):
+        try:
+            r = await client.fetch(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print('-- Err: could not fetch index: {} ({})'.format(url, e))
+            return None
+        try:
+            root = lxml.html.fromstring(r.text)
+        except (lxml.etree.ParserError, lxml.etree.XMLSyntaxError, ValueError):
+            return {}
         obj = {}
-        for row in parent:
-            p = d(row)
-            link = p('td:nth-child(3) > a')
-            href = link.attr('href')
+        for row in indexRows(root):
+            # The third cell links the document and the fourth holds its type
+            cells = [c for c in row if isinstance(c.tag, str)]
+            if len(cells) < 3 or cells[2].tag != 'td':
+                continue
+            link = cells[2].find('a')
+            href = link.get('href') if link is not None else None
             if not href:
                 continue
             if href.startswith('/'):
                 href = base + href
-            obj[p('td:nth-child(4)').text()] = href
+            obj[extract_text(cells[3]).strip() if len(cells) > 3 and cells[3].tag == 'td' else ''] = href
         return obj
 
     async def downloadFile(self, filing):
@@ -332,32 +584,86 @@ class Scrape:
         if not file:
             print('-- Err: no filing listed: %s' % [x for x in filing.keys()])
             return
+        # Streamed to a temporary file in fileFolder; writeFile renames it once the reference is known
+        path = '{}.{}.part'.format(self.fileFolder, filing['_accession'])
         try:
             print('-- Fetching: ' + file)
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/84.0.4147.105 Safari/537.36'
-            }
-            r = requests.get(file, headers=headers)
-        except:
+            async with client.stream(file) as r:
+                self.debug_url = r.url
+                size = await self.saveFile(r, path)
+        except aiohttp.InvalidURL:
             print('-- Err: malformed URL: ', file)
             return
-        self.debug_url = r.url
-        html = r.text
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print('-- Err: could not fetch: {} ({})'.format(file, e))
+            return
+        if not size:
+            self.removeFile(path)
+            return
+        return path
+
+    async def saveFile(self, r, path):
+        # Decoded chunk by chunk and written as utf-8 from a worker thread, so disk writes overlap with the network
+        loop = asyncio.get_running_loop()
+        try:
+            decoder = codecs.getincrementaldecoder(r.encoding)(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        head = ''
+        size = 0
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                async for chunk in r:
+                    text = decoder.decode(chunk)
+                    if head is not None:
+                        # Hold the start back until cleanHTML can see whether there is an XML prolog to strip
+                        head += text
+                        if len(head) < 5 or (head.startswith('<?xml') and '<body' not in head):
+                            continue
+                        text = self.cleanHTML(head)
+                        head = None
+                    size += len(text)
+                    await loop.run_in_executor(None, f.write, text)
+                text = decoder.decode(b'', final=True)
+                if head is not None:
+                    text = self.cleanHTML(head + text)
+                size += len(text)
+                f.write(text)
+        except BaseException:
+            self.removeFile(path)
+            raise
+        return size
+
+    def cleanHTML(self, html):
         if html.startswith('<?xml'):
             html = '<html><body' + html.split('<body')[1]
         return html
 
     # ### 5. Metadata parsing
 
+    def readMeta(self, path, filing):
+        # Documents up to streamThreshold are parsed once into a Document shared by every extractor.
+        # Larger ones are fed through a StreamExtract from disk, so no DOM of a huge 20-F is ever built.
+        if os.path.getsize(path) <= streamThreshold:
+            with open(path, encoding='utf-8') as f:
+                doc = Document(f.read())
+            return self.getTitle(doc, filing), self.getPages(doc)
+        stream = StreamExtract(filing['type'], pageBreakSize=pageBreakSize)
+        with open(path, encoding='utf-8') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                stream.feed(chunk)
+        stream.finish()
+        return stream.title(filing['type']), stream.pages
+
     def getDate(self, v):
         temp = datetime.datetime(1899, 12, 30)
         delta = v - temp
         return float(delta.days) + (float(delta.seconds) / 86400)
 
-    def getPages(self, html):
-        try:
-            d = pq(html)
-        except:
+    def getPages(self, doc):
+        d = doc.d
+        if d is None:
+            html = doc.html
             n = html.count('page-break-before') + html.count('page-break-after')
             if not n:
                 n = html.count('<hr')
@@ -367,39 +673,27 @@ class Scrape:
             breaks = d('hr[size="' + str(pageBreakSize) + '"], hr[noshade]')
         return len(breaks)
 
-    def getTitle(self, html, filing):
+    def getTitle(self, doc, filing):
         if filing['type'] == '6-K':
-            x = self.getTitleByP(html)
+            x = self.getTitleByP(doc)
             if not x:
-                x = self.getTitleByDiv(html)
+                x = self.getTitleByDiv(doc)
             return x
         else:
-            return self.getTitleByDiv(html)
+            return self.getTitleByDiv(doc)
 
 
-    def getTitleByP(self, html):
-        try:
-            d = pq(html)
-        except:
+    def getTitleByP(self, doc):
+        d = doc.d
+        if d is None:
             title = ''
-            matches = re.findall(r"<p.*><b>.*[a-zA-Z]+.*<\/b><\/p>", html)
-            for m in matches:
-                groups = re.search(r"<p.*><b>.*([a-zA-Z]+).*<\/b><\/p>", m)
-                if not len(groups.groups()):
+            for bold in patterns.boldParagraph.findall(doc.html):
+                if 'exhibit' in bold.lower():
                     continue
-                group = groups.group(1)
-                bolds = re.findall(r"<b>(?:<.*?>)?([\w\s]+)(?:<\/.*?>)?<\/b>", group)
-                for b in bolds:
-                    gs = re.search(r"<b>(?:<.*?>)?([\w\s]+)(?:<\/.*?>)?<\/b>", b)
-                    if not len(gs.groups()):
-                        continue
-                    bold = gs.group(1)
-                    if 'exhibit' in bold.lower():
-                        continue
-                    if bold == '&nbsp;':
-                        continue
-                    title += bold
-                    break
+                if bold == '&nbsp;':
+                    continue
+                title += bold
+                break
             return title
         arr = d.items('p')
         elem = None
@@ -419,93 +713,61 @@ class Scrape:
         text = elem.text().replace('\n', ' ')
         return text
 
-    def getTitleByDiv(self, html):
-        try:
-            d = pq(html)
-        except:
+    def getTitleByDiv(self, doc):
+        d = doc.d
+        if d is None:
             title = ''
-            matches = re.findall(r"<div.*><span>.*[a-zA-Z]+.*<\/span><\/div>", html)
-            for m in matches:
-                groups = re.search(r"<div.*><span>.*([a-zA-Z]+).*<\/span><\/div>", m)
-                if not len(groups.groups()):
+            for bold in patterns.boldSpan.findall(doc.html):
+                b = bold.lower().strip()
+                if not b:
                     continue
-                group = groups.group(1)
-                bolds = re.findall(r"<span.*?style=.*?font-weight:\s?bold.*?>(?:<.*?>)??(?:[\w\s-]|&nbsp;)+(?:<\/.*?>)??<\/span>", group)
-                for b in bolds:
-                    gs = re.search(r"<span.*?style=.*?font-weight:\s?bold.*?>(?:<.*?>)??((?:[\w\s-]|&nbsp;)+)(?:<\/.*?>)??<\/span>", b)
-                    if not len(gs.groups()):
-                        continue
-                    bold = gs.group(1)
-                    b = bold.lower().strip()
-                    if not b:
-                        continue
-                    if 'exhibit' in b:
-                        continue
-                    if bold == '&nbsp;':
-                        continue
-                    s = re.search(r"For\s+the\s+(fiscal\s+year|quarterly\s+period)\s+ended:?\s+(\w+\s+\d{1,2},\s+\d{1,4})", b)
-                    if not s:
-                        continue
-                    title += s.group(0)
-                    break
+                if 'exhibit' in b:
+                    continue
+                if bold == '&nbsp;':
+                    continue
+                s = patterns.fiscalTitle.search(bold.replace('&nbsp;', ' '))
+                if not s:
+                    continue
+                title += s.group(0)
+                break
             return title
-        arr = [x for x in d.items('div, p, td')]
-        elem = None
+        # Walks the tree lazily and stops at the first match or after 51 non-empty candidates. The emptiness test
+        # stops at the first non-blank text, so wrapper divs around the whole filing cost nothing, and the full text
+        # (the same text PyQuery's .text() gives) is only built for the few candidates that have bold markup.
         i = 0
-        for a in arr:
-            if not a.text().strip():
+        for a in doc.root.iter('div', 'p', 'td'):
+            if not any(t.strip() for t in a.itertext()):
                 continue
             if i > 50:
                 break
             i += 1
-            if not a.find(self.generateSelectors(
-                elements=['span', 'font'], attribs=['style'], keys=['font-weight'], values=['bold', '700']
-            ) + ', b') and 'font: bold' not in a.attr('style'):
+            if not hasBold(a) and 'font: bold' not in a.get('style', ''):
                 continue
-            if not re.search(r"For\s+the\s+(fiscal\s+year|quarterly\s+period)\s+ended:?\s+(\w+\s+\d{1,2},\s+\d{1,4})", a.text().strip()):
+            text = extract_text(a)
+            if not patterns.fiscalTitle.search(text.strip()):
                 continue
-            elem = a
-            break
-        if not elem:
-            return ''
-        s = re.search(r"For\s+the\s+(fiscal\s+year|quarterly\s+period)\s+ended:?\s+(\w+\s+\d{1,2},\s+\d{1,4})", elem.text().replace('\n', ' '))
-        if not s:
-            return ''
-        return s.group(0)
-
-    def generateSelectors(self, elements=[], attribs=[], keys=[], values=[]):
-        selectors = []
-        for e in elements:
-            for a in attribs:
-                for k in keys:
-                    for v in values:
-                        selectors.append('{}[{}*="{}:{}"]'.format(e, a, k, v))
-                        selectors.append('{}[{}*="{}: {}"]'.format(e, a, k, v))
-        return ', '.join(selectors)
+            s = patterns.fiscalTitle.search(text.replace('\n', ' '))
+            if not s:
+                return ''
+            return s.group(0)
+        return ''
 
     def getQuarter(self, filing):
         if filing['type'] != '6-K' and filing['type'] != '10-Q':
             return None
         t = filing['title'].lower()
-        if 'first quarter' in t or 'march' in t or 'april' in t:
-            return 1
-        if 'second quarter' in t or 'june' in t or 'july' in t:
-            return 2
-        if 'third quarter' in t or 'september' in t or 'october' in t:  # september 30 or october 1
-            return 3
-        if 'fourth quarter' in t or 'december' in t or 'january' in t:
-            return 4
-        return None
+        # september 30 or october 1 both mean the third quarter
+        quarters = [m.lastindex for m in patterns.quarter.finditer(t)]
+        if not quarters:
+            return None
+        return min(quarters)
 
     def getReference(self, filing):
-        matches = re.search(r"[0-9]\s?[0-9]\s?[0-9]\s?[0-9]", filing['title']) 
+        matches = patterns.year.search(filing['title'])
         if not matches:
             return ''
         year = matches[0].replace(' ', '')
         if filing['quarter']:
-            matches = re.search(r"[0-9]\s?[0-9]\s?[0-9]\s?[0-9]", filing['title'])
-            if not matches:
-                return ''
             return year + '-Q' + str(filing['quarter'])
         else:
             return int(year)
@@ -545,20 +807,65 @@ class Scrape:
 
     # ### Run
 
-async def main():
+async def scrapeAll(scrapes):
+    try:
+        # Every company runs at once; sheets are still merged in the order of the companies dict
+        return await asyncio.gather(*[s.run() for s in scrapes])
+    finally:
+        await client.close()
+        if catalog is not None:
+            catalog.close()
+        print('\nRequests: {requests}, throttled: {throttled}, retried: {retried}, failed: {failed}, cache hits: {hits}, revalidated: {revalidated}'.format(**client.stats))
+
+async def main(sink=None):
+    global journal
+    if report and catalog is None:
+        sys.exit('--report builds the workbook from the catalog, but catalogPath is empty. Set it to the catalog earlier runs wrote.')
     output = {}
+    scrapes = []
     for companyName, data in companies.items():
         if 'skip' in data and data['skip']:
             continue
-        s = Scrape(companyName=companyName, cik=data['cik'], codes=data['codes'])
-        obj = await s.run()
+        scrapes.append(Scrape(companyName=companyName, cik=data['cik'], codes=data['codes'], sink=sink))
+    if fullIndex and not report:
+        # Read and filtered once for every company, in place of their browse-edgar feeds
+        with metrics.stage('fullindex', fullIndexFiles):
+            index = fullindex.select(
+                fullindex.load(sorted(glob(fullIndexFiles, recursive=True))),
+                ciks=[s.cik for s in scrapes],
+                types={ c for s in scrapes for c in s.codes },
+                datestart=datestart,
+                dateend=dateend
+            )
+        for s in scrapes:
+            s.index = index[index['cik'] == int(s.cik)]
+    if journalPath and not report:
+        journal = Journal(journalPath, resume)
+        if resume:
+            print('Resuming: {} filings already finished'.format(len(journal.finished)))
+    if report:
+        # No network: every sheet comes from the catalog
+        results = [s.report() for s in scrapes]
+        catalog.close()
+    else:
+        results = await scrapeAll(scrapes)
+    for s, obj in zip(scrapes, results):
         for k in obj.keys():
             obj[k].name = s.workbookTitle
-            obj[k].src = '{} SEC Filings ({}-{}), {}/cgi-bin/browse-edgar?CIK={}'.format(s.workbookTitle, datestart.split('-')[0], dateend.split('-')[0], base, data['cik'])
+            obj[k].src = '{} SEC Filings ({}-{}), {}/cgi-bin/browse-edgar?CIK={}'.format(s.workbookTitle, datestart.split('-')[0], dateend.split('-')[0], base, s.cik)
         output.update(obj)
-    xlsx(output, workbookName=workbookName)
-
-asyncio.run(main())
+    with metrics.stage('xlsx', workbookName):
+        xlsx(output, workbookName=workbookName)
+    if journal is not None:
+        journal.clear()
+    if metricsPath:
+        metrics.write(metricsPath, client.stats)
+
+if __name__ == '__main__':
+    if '--profile' in sys.argv[1:]:
+        profile(lambda: asyncio.run(main()), profilePath)
+    else:
+        asyncio.run(main())
 
 # Aloysius Lip 2020
 # 
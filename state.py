@@ -0,0 +1,126 @@
+import os
+import json
+import datetime
+
+
+# Per CIK and form code record of the filings an earlier run has already processed.
+# Rows are stored newest first, the same order the browse-edgar feed lists them in. Filings whose download failed are
+# kept as pending feed rows: the next run stops paging at the first accession it knows, which is usually newer than
+# them, so it queues them again from here.
+
+class State:
+
+    def __init__(self, cik='', code='', folder='./state/'):
+        self.path = os.path.join(folder, '{}-{}.json'.format(cik, code.replace('/', '_')))
+        self.accessions = set()
+        self.rows = []
+        self.pending = {}
+        self.load()
+
+    def __contains__(self, accession):
+        return accession in self.accessions
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.accessions = set(data.get('accessions', []))
+        self.rows = data.get('rows', [])
+        self.pending = { p['accession']: p for p in data.get('pending', []) }
+
+    def update(self, accessions, rows, failed=[]):
+        # Private '_' keys hold datetimes and other run-only values, so they are not persisted.
+        # failed are the feed rows of filings that are not done with; they stay pending until a run finishes them
+        rows = [{ k: v for k, v in row.items() if not k.startswith('_') } for row in rows]
+        self.accessions.update(accessions)
+        for accession in accessions:
+            self.pending.pop(accession, None)
+        for row in failed:
+            self.pending[row['_accession']] = {
+                'accession': row['_accession'],
+                'datetime': row['_datetime'].isoformat(),
+                'date': row['date'],
+                'type': row['type'],
+                'index': row['index']
+            }
+        # A retried filing can be older than rows already stored, so the dates put it back in place
+        self.rows = sorted(rows + self.rows, key=lambda r: r['date'], reverse=True)
+
+    def retry(self):
+        # The pending filings as Scrape.parse builds feed rows, to be queued again
+        return [{
+            'date': p['date'],
+            'type': p['type'],
+            'index': p['index'],
+            'source': '',
+            '_datetime': datetime.datetime.fromisoformat(p['datetime']),
+            '_accession': accession
+        } for accession, p in self.pending.items()]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({ 'accessions': sorted(self.accessions), 'rows': self.rows, 'pending': list(self.pending.values()) }, f, indent=4, default=str)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Append-only checkpoint of the filings a run has finished, one JSON line each, for picking a run back up with --resume.
+# A finished filing is replayed from here instead of being fetched and parsed again; anything that was still in
+# flight when the run died has no line yet, so it is simply queued again. The raw responses themselves are already
+# kept by fetch.Cache, so even re-queued filings rarely go back to the network.
+
+class Journal:
+
+    def __init__(self, path='./state/journal.jsonl', resume=False):
+        self.path = path
+        self.finished = {}
+        if resume:
+            self.load()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Rewritten from the records that loaded, which also drops a line torn by the crash
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            for accession, row in self.finished.items():
+                f.write(json.dumps({ 'accession': accession, 'row': row }, default=str) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def __contains__(self, accession):
+        return accession in self.finished
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.finished[record['accession']] = record['row']
+        except OSError:
+            pass
+
+    def record(self, accession, filing):
+        # filing is the finished row, or None for a filing left out of the table. Flushed at once, so it survives a crash
+        row = None if filing is None else { k: v for k, v in filing.items() if not k.startswith('_') }
+        self.finished[accession] = row
+        self.file.write(json.dumps({ 'accession': accession, 'row': row }, default=str) + '\n')
+        self.file.flush()
+
+    def replay(self, row):
+        # The same (filing, done) pair parseFiling returned, with the run-only '_' keys taken from the feed row
+        stored = self.finished[row['_accession']]
+        return (None if stored is None else { **row, **stored }), True
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def clear(self):
+        # Called once the workbook is written; the next run starts from scratch
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -1,4 +1,5 @@
 import os
+import io
 import xmltodict
 import openpyxl
 import xlsxwriter
@@ -7,8 +8,10 @@ import pandas as pd
 import pandas.io.formats.excel
 
 
-def xlsx(tables={}, companyName='', header='', source='', start_row=7, start_column=1, colour='#44556a', insertLogo='./FTI.jpg', workbookName='', outDir='', date_format='yyyy-mm-dd', other_headers=False):
+def xlsx(tables={}, companyName='', header='', source='', start_row=7, start_column=1, colour='#44556a', insertLogo='./FTI.jpg', workbookName='', outDir='', date_format='yyyy-mm-dd', other_headers=False, fast=False):
 	# pylint: disable=abstract-class-instantiated
+    if fast:
+        return xlsxFast(tables, companyName, header, source, start_row, start_column, colour, insertLogo, workbookName, outDir, date_format, other_headers)
     f = pd.ExcelWriter(outDir.replace('/', '\\') + workbookName + '.xlsx', engine='xlsxwriter')
 	
     def capitalize(s):
@@ -95,3 +98,96 @@ def xlsx(tables={}, companyName='', header='', source='', start_row=7, start_col
 
     workbook.close()
     print('Wrote to: {}\\{}{}.xlsx'.format(os.getcwd(), outDir.replace('/', '\\'), workbookName))
+
+
+# Same workbook as xlsx, written with xlsxwriter directly instead of through df.to_excel.
+# constant_memory flushes each row to disk as soon as the next one starts, so every sheet is written strictly top to bottom.
+# Formats are created once per workbook and the logo is read once; xlsxwriter stores identical images only once.
+
+def xlsxFast(tables={}, companyName='', header='', source='', start_row=7, start_column=1, colour='#44556a', insertLogo='./FTI.jpg', workbookName='', outDir='', date_format='yyyy-mm-dd', other_headers=False):
+    workbook = xlsxwriter.Workbook(outDir.replace('/', '\\') + workbookName + '.xlsx', { 'constant_memory': True })
+
+    def capitalize(s):
+        s = str(s)
+        if not s:
+            if other_headers:
+                return 'Other'
+            else:
+                return ''
+        return s[0].capitalize() + s[1:]
+
+    std = { 'border': 0, 'bg_color': 'white', 'num_format': '#,##0;[Black](#,##0)' }
+
+    # Default formats for any FTI sheet
+    std_fmt = workbook.add_format(std)
+    dt_format = workbook.add_format({ **std, 'num_format': date_format, 'align': 'left' })
+    bold_fmt = workbook.add_format({ **std, 'bold': True })
+    highlighted_fmt = workbook.add_format({ **std, 'bold': True, 'color': 'white', 'bg_color': colour })
+    header_format = workbook.add_format({ **std, 'bold': True, 'align': 'left' })
+    header_format.set_bottom(1)
+    header_format.set_top(1)
+    footer_format = workbook.add_format({ **std, 'italic': True })
+    footer_format.set_top(2)
+
+    logo = None
+    if insertLogo:
+        with open(insertLogo, 'rb') as fh:
+            logo = fh.read()
+
+    for sheet_name, data in tables.items():
+        df = None
+        if isinstance(data, pd.DataFrame):
+            df = data
+            if 'name' in df:
+                companyName = df.name
+            if 'src' in df:
+                source = df.src
+        else:
+            df = data.data
+            source = data.source
+            header = data.name
+        worksheet = workbook.add_worksheet(sheet_name)
+        columns = list(df.columns.values)
+
+        # Columns
+        worksheet.set_column(0, start_column - 1, 2, std_fmt)
+        formats = []
+        for i, h in enumerate(columns):
+            if 'date' in h.lower():
+                worksheet.set_column('B:B', 12, dt_format)
+                formats.append(dt_format)
+            elif 'title' in h.lower() and len(df[h]):
+                worksheet.set_column(start_column + i, start_column + i, round(df[h].astype(str).str.len().mean()), std_fmt) # TODO: filter out no content from average
+                formats.append(std_fmt)
+            else:
+                worksheet.set_column(start_column + i, start_column + i, None, std_fmt)
+                formats.append(std_fmt)
+        worksheet.set_column(start_column + len(columns), start_column + len(columns) + 10, None, std_fmt)
+
+        # Headers, in row order from here on
+        worksheet.write(1, 1, companyName, bold_fmt)
+        worksheet.write(2, 1, workbookName, bold_fmt)
+        worksheet.write(3, 1, 'FTI Consulting', bold_fmt)
+        if logo:
+            worksheet.insert_image('D2', insertLogo, { 'image_data': io.BytesIO(logo) })
+
+        # Header content
+        worksheet.write(start_row - 2, start_column, header or sheet_name, highlighted_fmt)
+        for col_num in range(start_column + 1, start_column + len(columns)):
+            worksheet.write(start_row - 2, col_num, '', highlighted_fmt)
+        for col_num, value in enumerate(columns):
+            worksheet.write(start_row, start_column + col_num, capitalize(value), header_format)
+
+        # Rows. Object dtype turns numpy scalars into Python ones and NaN/NaT into None, which are written as blank cells
+        values = df.astype(object).where(df.notna(), None).values.tolist()
+        for r, row in enumerate(values):
+            for c, value in enumerate(row):
+                worksheet.write(start_row + 1 + r, start_column + c, value, formats[c])
+
+        # Footer content
+        worksheet.write(start_row + len(df) + 1, start_column, 'Source: {}'.format(source), footer_format)
+        for col_num in range(start_column + 1, start_column + len(columns)):
+            worksheet.write(start_row + len(df) + 1, col_num, '', footer_format)
+
+    workbook.close()
+    print('Wrote to: {}\\{}{}.xlsx'.format(os.getcwd(), outDir.replace('/', '\\'), workbookName))